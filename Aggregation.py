@@ -0,0 +1,142 @@
+import random
+
+from config import QUANTILE_SKETCH_CAPACITY
+
+
+class QuantileSketch:
+    """
+    Mergeable approximate quantiles in bounded memory (a simple KLL-style sketch). Each level holds values with a
+    weight of 2 ** level, and a full level is compacted by sorting it and promoting every other value to the next level.
+    """
+
+    def __init__(self, capacity=QUANTILE_SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.levels = [[]]
+
+    def add(self, value):
+        self.levels[0].append(value)
+        if len(self.levels[0]) > self.capacity:
+            self._compress()
+
+    def merge(self, other):
+        """
+        Adds all the values summarised by another sketch to this one.
+        """
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].extend(values)
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity:
+                values = sorted(self.levels[level])
+                # keep one back if there's an odd number so the promoted values carry exactly half the weight
+                kept = [values.pop()] if len(values) % 2 == 1 else []
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[level + 1].extend(values[random.randint(0, 1)::2])
+                self.levels[level] = kept
+            level += 1
+
+    def quantile(self, fraction):
+        """
+        :param fraction: Quantile to find, between 0 and 1 (e.g. .5 for the median)
+        :return: The approximate quantile, or None if no values have been added
+        """
+        weighted = sorted((value, 2 ** level) for level, values in enumerate(self.levels) for value in values)
+        if len(weighted) == 0:
+            return None
+
+        target = fraction * sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+
+class SummaryStatistics:
+    """
+    Running summary of one type of logged information: count, mean, variance, quantiles and the final value of each
+    model run. Summaries from different model runs can be merged without going back to the raw rows.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of squared differences from the mean
+        self.sketch = QuantileSketch()
+
+        # the latest value of the current model run, and the final value of each finished run
+        self._last_time = None
+        self._last_value = None
+        self.final_values = []
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def final(self):
+        """
+        Mean of the final values of all the model runs.
+        """
+        if len(self.final_values) == 0:
+            return None
+        return sum(self.final_values) / len(self.final_values)
+
+    def quantile(self, fraction):
+        return self.sketch.quantile(fraction)
+
+    def add(self, value, timestamp):
+        """
+        Adds a single logged value.
+
+        :param value: The value logged
+        :param timestamp: Time it was logged at (used to find the run's final value)
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.sketch.add(value)
+
+        if self._last_time is None or timestamp >= self._last_time:
+            self._last_time = timestamp
+            self._last_value = value
+
+    def end_run(self):
+        """
+        Records the latest value as the final value of the model run.
+        """
+        if self._last_time is not None:
+            self.final_values.append(self._last_value)
+        self._last_time = None
+        self._last_value = None
+
+    def merge(self, other):
+        """
+        Adds another summary (e.g. of a different model run) into this one.
+        """
+        if other.count == 0:
+            self.final_values.extend(other.final_values)
+            return
+
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta ** 2 * self.count * other.count / total
+        self.mean += delta * other.count / total
+        self.count = total
+        self.sketch.merge(other.sketch)
+        self.final_values.extend(other.final_values)
+
+    def __str__(self):
+        return "n={}, mean={}, var={}, median={}, final={}".format(self.count, round(self.mean, 3),
+                                                                   round(self.variance, 3), self.quantile(.5),
+                                                                   self.final)
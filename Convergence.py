@@ -0,0 +1,113 @@
+import math
+import time
+
+from distributed import Event
+
+from config import STOP_EVENT_NAME
+
+
+class TrainingStopped(Exception):
+    """
+    Raised by an experiment that was stopped part way through because training stopped early.
+    """
+    pass
+
+
+def training_stopped():
+    """
+    Checks if training has stopped early and asked the experiments still running to stop (see Train.solve).
+
+    :return: True if they should stop. Always False when not running on a dask cluster.
+    """
+    event = Event(STOP_EVENT_NAME)
+    if event.client is None:
+        return False
+    return event.is_set()
+
+
+class StoppingCriteria:
+    """
+    Decides when a training run should stop early. A criterion set to None is not checked.
+    """
+
+    def __init__(self, stall_evaluations=None, min_swarm_diameter=None, max_seconds=None, max_model_runs=None):
+        """
+        :param stall_evaluations: Stop after this many evaluations without a global best improvement
+        :param min_swarm_diameter: Stop when the swarm's diameter (diagonal of the bounding box of all particle
+                                   positions) falls below this
+        :param max_seconds: Stop after this much wall-clock time
+        :param max_model_runs: Stop after this many model runs
+        """
+        self.stall_evaluations = stall_evaluations
+        self.min_swarm_diameter = min_swarm_diameter
+        self.max_seconds = max_seconds
+        self.max_model_runs = max_model_runs
+
+        self.start_time = time.time()
+        self.evaluations_since_improvement = 0
+        self.model_runs = 0
+
+    def start(self):
+        """
+        Restart the clock (called when solving starts).
+        """
+        self.start_time = time.time()
+
+    def remaining_seconds(self):
+        """
+        :return: Wall-clock time left in the budget, or None if there is no time budget
+        """
+        if self.max_seconds is None:
+            return None
+        return max(self.max_seconds - (time.time() - self.start_time), 0)
+
+    def add_evaluation(self, improved, model_runs):
+        """
+        Record a finished particle evaluation.
+
+        :param improved: True if the evaluation improved the global best score
+        :param model_runs: Number of model runs the evaluation cost
+        """
+        if improved:
+            self.evaluations_since_improvement = 0
+        else:
+            self.evaluations_since_improvement += 1
+        self.model_runs += model_runs
+
+    @staticmethod
+    def swarm_diameter(positions):
+        """
+        Length of the diagonal of the bounding box around the positions.
+
+        :param positions: List of position dictionaries {name: value}
+        :return: The swarm diameter
+        """
+        total = 0
+        for name in positions[0]:
+            values = [position[name] for position in positions]
+            total += (max(values) - min(values)) ** 2
+        return math.sqrt(total)
+
+    def stop_reason(self, positions):
+        """
+        Checks all the criteria.
+
+        :param positions: List of the current particle positions
+        :return: A description of why training should stop, or None to keep going
+        """
+        if self.stall_evaluations is not None and self.evaluations_since_improvement >= self.stall_evaluations:
+            return "no global best improvement in {} evaluations".format(self.evaluations_since_improvement)
+
+        if self.min_swarm_diameter is not None:
+            diameter = self.swarm_diameter(positions)
+            if diameter < self.min_swarm_diameter:
+                return "swarm diameter {} below {}".format(round(diameter, 3), self.min_swarm_diameter)
+
+        elapsed = time.time() - self.start_time
+        if self.max_seconds is not None and elapsed >= self.max_seconds:
+            return "wall-clock budget of {}s used ({}s)".format(self.max_seconds, round(elapsed))
+
+        if self.max_model_runs is not None and self.model_runs >= self.max_model_runs:
+            return "model run budget of {} used ({} runs)".format(self.max_model_runs, self.model_runs)
+
+        return None
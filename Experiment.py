@@ -1,13 +1,19 @@
 from dask.distributed import get_client
 from dask.distributed import secede, rejoin
+from dask.distributed import as_completed, Queue
 
 import os.path
 import shutil
 import random
+from collections import defaultdict
 
-from Model import run_model
+from Model import warm_up, run_model, run_models
 from Logger import Logger
-from config import OUTPUT_DIR
+from Aggregation import SummaryStatistics
+from Resources import models_per_task, model_resources, merge_resources
+from Convergence import TrainingStopped, training_stopped
+from config import OUTPUT_DIR, MODELS_PER_WORKER, WARMUP_STEPS, RECORD_RAW_ROWS, MODEL_STEPS_RANGE, MERGE_QUEUE_NAME, \
+    MODEL_MEMORY_GB
 
 
 class Experiment:
@@ -15,9 +21,22 @@ class Experiment:
     An experiment runs the base_model with varying parameters, with multiple replications of each parameter set.
     """
 
-    def __init__(self, name, num_replications, scratch_path):
+    def __init__(self, name, num_replications, scratch_path, models_per_worker=MODELS_PER_WORKER,
+                 warmup_steps=WARMUP_STEPS, record_rows=RECORD_RAW_ROWS, model_memory_gb=MODEL_MEMORY_GB):
         self.scratch_path = scratch_path
 
+        # memory each model run declares it needs, in GB
+        self.model_memory_gb = model_memory_gb
+
+        # False to only keep summary statistics of the model outputs (no raw rows written to DBs)
+        self.record_rows = record_rows
+
+        # steps shared by all the replications of a scenario, run once and forked from a snapshot instead of re-run
+        self.warmup_steps = warmup_steps
+
+        # models run together on one event loop in a single task (1 runs each model in its own task)
+        self.models_per_worker = models_per_worker
+
         # get rid of any incidental spaces in the experiment name
         self.name = name.replace(" ", "_")
 
@@ -27,6 +46,10 @@ class Experiment:
 
         self.model_times = {}  # {(model_id, run_id): days, ...}
 
+        # summary of the model outputs, updated as each model run finishes:
+        # {(scenario_name, info_type): SummaryStatistics}
+        self.aggregates = defaultdict(SummaryStatistics)
+
     def add_scenario(self, scenario_name, parameter_dict):
         """
         Adds a scenario for this experiment to run. The scenario contains information for running a model.
@@ -39,6 +62,8 @@ class Experiment:
     def run_experiment(self):
         """
         Run the experiment. Including all scenarios and replications.
+
+        :return: Summary statistics of the model outputs: {(scenario_name, info_type): SummaryStatistics}
         """
         dask_client = get_client(timeout=600)
 
@@ -50,7 +75,7 @@ class Experiment:
         # except ValueError:
         #     seceded = False
 
-        futures = []
+        run_specs = []
         total_runs = len(self.scenarios) * self.num_replications
         for scenario in self.scenarios:
             scenario_name, configuration = scenario
@@ -59,21 +84,101 @@ class Experiment:
             replications_done = 0
 
             # random number of steps for this scenario
-            total_steps = random.randint(300, 700)
+            total_steps = random.randint(*MODEL_STEPS_RANGE)
 
-            for run_id in range(replications_done, self.num_replications):
-                future = dask_client.submit(run_model, self.name, scenario_name, run_id, total_runs, total_steps,
-                                            self.scratch_path)
-                futures.append(future)
+            # run the warm-up once in its own task, and pass its snapshot (future) to all the replications
+            snapshot = None
+            if self.warmup_steps > 0:
+                snapshot = dask_client.submit(warm_up, self.name, scenario_name, total_steps, self.scratch_path,
+                                              self.warmup_steps, self.record_rows,
+                                              resources=model_resources(dask_client, 1, self.model_memory_gb),
+                                              pure=False)
 
-        loggers_info = dask_client.gather(futures)
+            for run_id in range(replications_done, self.num_replications):
+                run_specs.append((self.name, scenario_name, run_id, total_runs, total_steps, self.scratch_path,
+                                  snapshot, self.record_rows))
+
+        # aggregate the outputs as each model run finishes
+        loggers_info = []
+        for run_spec, (logger_filepath, logger_tables, logger_summaries) in \
+                self.run_model_specs(dask_client, run_specs, self.models_per_worker, self.model_memory_gb):
+            for info_type, summary in logger_summaries.items():
+                self.aggregates[(run_spec[1], info_type)].merge(summary)
+            if len(logger_tables) > 0:
+                loggers_info.append((logger_filepath, logger_tables))
+
+        if len(loggers_info) > 0:
+            # gather all the output dbs into a single db without waiting for it, handing the future to training (which
+            # waits for all the merges before it finishes)
+            future = dask_client.submit(Experiment.save_raw_rows, self.name, loggers_info,
+                                        resources=merge_resources(dask_client))
+            Queue(MERGE_QUEUE_NAME, client=dask_client).put(future)
 
         # if seceded:
         print("rejoin: {}".format(self.name))
         rejoin()
 
-        # gather all the output dbs into a single db
-        out_db_filepath = Logger.gather_databases(self.name, loggers_info)
+        return dict(self.aggregates)
+
+    @staticmethod
+    def run_model_specs(dask_client, run_specs, models_per_worker, model_memory_gb=MODEL_MEMORY_GB):
+        """
+        Runs models on the cluster. Groups of up to models_per_worker models (as many as fit on a worker) are
+        co-scheduled on an event loop in each task.
+
+        :param dask_client: Client connected to the cluster to run the models on
+        :param run_specs: List of run_model arguments for each model (see Model.run_models)
+        :param models_per_worker: Number of models wanted in each task (1 runs each model in its own task)
+        :param model_memory_gb: Memory each model run needs in GB
+        :return: Generator of (run_spec, (logger_filepath, logger_tables, logger_summaries)) for each model run, as
+                 they finish
+        :raises TrainingStopped: If training stops early while the models run. The models stop at their next step
+                                 (or before their first), and all their DBs are removed.
+        """
+        group_size = models_per_task(dask_client, models_per_worker, model_memory_gb)
+
+        future_specs = {}  # {future: [run_spec for each model run in the task]}
+        if group_size > 1:
+            for group_start in range(0, len(run_specs), group_size):
+                group = run_specs[group_start:group_start + group_size]
+                future = dask_client.submit(run_models, group,
+                                            resources=model_resources(dask_client, len(group), model_memory_gb),
+                                            pure=False)
+                future_specs[future] = group
+        else:
+            resources = model_resources(dask_client, 1, model_memory_gb)
+            for run_spec in run_specs:
+                future = dask_client.submit(run_model, *run_spec, resources=resources, pure=False)
+                future_specs[future] = [run_spec]
+
+        db_filepaths = []
+        stopped = False
+        for future, result in as_completed(list(future_specs), with_results=True):
+            results = result if group_size > 1 else [result]
+            for run_spec, run_result in zip(future_specs[future], results):
+                db_filepaths.append(run_result[0])
+                if not stopped:
+                    yield run_spec, run_result
+
+            # once training stops, the rest of the models stop straight away - collect them so their DBs can go too
+            stopped = stopped or training_stopped()
+
+        if stopped:
+            for db_filepath in db_filepaths:
+                if os.path.exists(db_filepath):
+                    os.remove(db_filepath)
+            raise TrainingStopped("training stopped while running {} models".format(len(run_specs)))
+
+    @staticmethod
+    def save_raw_rows(experiment_name, loggers_info):
+        """
+        Gathers the raw rows from all the model DBs into a single experiment DB in the output directory.
+
+        :param experiment_name: Name of the experiment. Used as the name of the output DB.
+        :param loggers_info: List specifying all the model DBs: [(model_db_filepath, {table_name: 1}), ...]
+        :return: Path of the experiment DB
+        """
+        out_db_filepath = Logger.gather_databases(experiment_name, loggers_info)
 
         dest_file_path_name = os.path.join(OUTPUT_DIR, os.path.split(out_db_filepath)[1])
 
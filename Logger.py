@@ -2,8 +2,11 @@ import sqlite3
 from collections import defaultdict
 import os.path
 import datetime
+import asyncio
 
 from HelpFunctions import error_print
+from Aggregation import SummaryStatistics
+from config import LOG_BUFFER_SIZE, RECORD_RAW_ROWS
 
 
 class Logger:
@@ -17,7 +20,7 @@ class Logger:
         name = "{}-sc_{}-rep_{}.db".format(*names)
         return name
 
-    def __init__(self, experiment_name, scenario_name, run_id, scratch_path):
+    def __init__(self, experiment_name, scenario_name, run_id, scratch_path, record_rows=RECORD_RAW_ROWS):
         """
         Start up a logger to record information for a unique model run.
         The DB unique name is made up of the experiment name, scenario name, and run ID.
@@ -26,10 +29,12 @@ class Logger:
         :param scenario_name: Name of the scenario. Used to name the database.
         :param run_id: ID of this replication/run. Used to name the database.
         :param scratch_path: Relative or absolute path for location to create DB.
+        :param record_rows: False to only keep summary statistics, without writing the raw rows to the DB.
         """
         self.experiment_name = experiment_name
         self.scenario_name = scenario_name
         self.run_id = run_id
+        self.record_rows = record_rows
 
         self.end_step = 0
 
@@ -48,6 +53,13 @@ class Logger:
 
         self._property_loggers = defaultdict(set)
 
+        # summary of everything logged, updated as it's logged: {info_type: SummaryStatistics}
+        self.summaries = defaultdict(SummaryStatistics)
+
+        # rows waiting to be written by flush(): {table_name: [row, ...]}
+        self._buffer = defaultdict(list)
+        self._buffered_rows = 0
+
     def create_log_table(self, table_name):
         """
         Creates a table in the database for logging a type of information.
@@ -72,6 +84,9 @@ class Logger:
         :param timestamp: Time being logged (days)
         :param value: The information to be recorded.
         """
+        self.summaries[info_type].add(value, timestamp)
+        if not self.record_rows:
+            return
 
         insert_str = "INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(info_type)
         # print("Logger e{}:s{}:r{} connecting {}".format(self.experiment_name, self.scenario_name, self.run_id,
@@ -89,6 +104,7 @@ class Logger:
                                       ON CONFLICT REPLACE)""".format(info_type)
                     log_db.execute(create_str)
                     log_db.execute(insert_str, (self.scenario_name, self.run_id, info_string, timestamp, value))
+                    self.tables[info_type] = 1
                 except sqlite3.OperationalError as e2:
                     error_print("--- 2: {}".format(e2))
                     error_print("")
@@ -102,12 +118,86 @@ class Logger:
         # print("  Logger e{}:s{}:r{} disc. {}".format(self.experiment_name, self.scenario_name, self.run_id,
         #                                                     self.db_filepath))
 
+    async def log_info_async(self, info_type, info_string, timestamp, value):
+        """
+        Logs a single bit of information from a model running on an event loop. Rows are buffered and written
+        in an executor thread so waiting on the database doesn't hold up the other models on the loop.
+
+        :param info_type: String name for the type of information being logged (table name)
+        :param info_string: String description of this entry
+        :param timestamp: Time being logged (days)
+        :param value: The information to be recorded.
+        """
+        self.summaries[info_type].add(value, timestamp)
+        if not self.record_rows:
+            return
+
+        self._buffer[info_type].append((self.scenario_name, self.run_id, info_string, timestamp, value))
+        self._buffered_rows += 1
+        if self._buffered_rows >= LOG_BUFFER_SIZE:
+            await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    def flush(self):
+        """
+        Writes all the buffered rows to the database.
+        """
+        buffer = self._buffer
+        self._buffer = defaultdict(list)
+        self._buffered_rows = 0
+
+        for table_name in buffer:
+            if table_name not in self.tables:
+                self.create_log_table(table_name)
+
+        with sqlite3.connect(self.db_filepath, timeout=60) as log_db:
+            for table_name, rows in buffer.items():
+                insert_str = "INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(table_name)
+                log_db.executemany(insert_str, rows)
+
+    def logged_rows(self):
+        """
+        Everything logged so far, without the scenario name and run ID.
+
+        :return: Dictionary of rows for each table: {table_name: [(type, time, value), ...]}
+        """
+        if self._buffered_rows > 0:
+            self.flush()
+
+        rows = {}
+        if not os.path.exists(self.db_filepath):
+            return rows
+        with sqlite3.connect(self.db_filepath, timeout=60) as log_db:
+            table_names = [row[0] for row in log_db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            for table_name in table_names:
+                rows[table_name] = log_db.execute("SELECT type, time, value FROM {}".format(table_name)).fetchall()
+        return rows
+
+    def restore_rows(self, rows):
+        """
+        Logs rows from another logger (see logged_rows()) as this logger's own.
+
+        :param rows: Dictionary of rows for each table: {table_name: [(type, time, value), ...]}
+        """
+        for table_name, table_rows in rows.items():
+            self._buffer[table_name].extend((self.scenario_name, self.run_id, *row) for row in table_rows)
+            self._buffered_rows += len(table_rows)
+        if self._buffered_rows > 0:
+            self.flush()
+
     def end_scenario(self, time_step):
         """
         Caps off all the tables with -1
 
         :param time_step: The time value for the capping entries
         """
+        for summary in self.summaries.values():
+            summary.end_run()
+        if not self.record_rows:
+            return
+
+        if self._buffered_rows > 0:
+            self.flush()
+
         with sqlite3.connect(self.db_filepath, timeout=60) as log_db:
             for table_name in self.tables:
                 insert_str = "INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(table_name)
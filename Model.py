@@ -3,19 +3,46 @@ import itertools
 import copy
 import random
 import time
+import asyncio
+import os.path
 
 from Logger import Logger
+from Convergence import training_stopped
+from config import RECORD_RAW_ROWS, STEP_SECONDS_RANGE, STOP_CHECK_SECONDS
 
 
-def run_model(experiment_name, scenario_name, run_id, total_runs, total_steps, scratch_path):
+def warm_up(experiment_name, scenario_name, total_steps, scratch_path, warmup_steps, record_rows=RECORD_RAW_ROWS):
+    """
+    Runs the warm-up steps shared by all the replications of a scenario, once, in its own task. The replications
+    are passed its snapshot (so dask runs each warm-up once and keeps the snapshot on the workers that need it).
+
+    :param total_steps: Total number of steps the scenario's models run for (the warm-up is never longer)
+    :param warmup_steps: Number of steps to run
+    :return: Snapshot of the model at the end of the warm-up, for the replications to fork from
+    """
+    model = Model(experiment_name, scenario_name, "warmup", scratch_path, record_rows)
+    model.total_steps = total_steps
+
+    model.start(1)
+    model.run_to_step(min(warmup_steps, model.total_steps))
+    snapshot = model.snapshot()
+
+    # the replications log the warm-up's rows as their own, so its DB isn't needed
+    if os.path.exists(model.logger.db_filepath):
+        os.remove(model.logger.db_filepath)
+    return snapshot
+
+
+def run_model(experiment_name, scenario_name, run_id, total_runs, total_steps, scratch_path, snapshot=None,
+              record_rows=RECORD_RAW_ROWS):
     # print("    scenario {}: rep {} started".format(scenario_name, run_id))
 
-    model = Model(experiment_name, scenario_name, run_id, scratch_path)
+    model = Model(experiment_name, scenario_name, run_id, scratch_path, record_rows)
 
     from timeit import default_timer as timer
     start = timer()
 
-    logger_filepath, logger_tables = model.run(total_runs, total_steps)
+    logger_filepath, logger_tables, logger_summaries = model.run(total_runs, total_steps, snapshot)
 
     del model
 
@@ -26,7 +53,35 @@ def run_model(experiment_name, scenario_name, run_id, total_runs, total_steps, s
     # print("      Scenario_{}-rep_{} took {}h:{:0>2}m:{:0>2}s".format(scenario_name, run_id, hours, minutes,
     #                                                                  round(seconds)))
 
-    return logger_filepath, logger_tables
+    return logger_filepath, logger_tables, logger_summaries
+
+
+def run_models(run_specs):
+    """
+    Runs many models on a single event loop, interleaving their steps while they wait. All the models run at once:
+    the task's size is limited by the number of run_specs (and the resources it declares), and how many tasks a
+    worker runs at once by its threads and resources.
+
+    :param run_specs: List of run_model arguments for each model:
+                      [(experiment_name, scenario_name, run_id, total_runs, total_steps, scratch_path[,
+                        snapshot[, record_rows]]), ...]
+    :return: List of (logger_filepath, logger_tables, logger_summaries) for each model, in the same order as
+             run_specs
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run_models_async(run_specs))
+    finally:
+        loop.close()
+
+
+async def _run_models_async(run_specs):
+    async def run_one(experiment_name, scenario_name, run_id, total_runs, total_steps, scratch_path, snapshot=None,
+                      record_rows=RECORD_RAW_ROWS):
+        model = Model(experiment_name, scenario_name, run_id, scratch_path, record_rows)
+        return await model.run_async(total_runs, total_steps, snapshot)
+
+    return await asyncio.gather(*[run_one(*run_spec) for run_spec in run_specs])
 
 
 class Model:
@@ -34,7 +89,7 @@ class Model:
     A generic model. Manages generating data and recording for one scenario replication.
     """
 
-    def __init__(self, experiment_name, scenario_name, run_id, scratch_path):
+    def __init__(self, experiment_name, scenario_name, run_id, scratch_path, record_rows=RECORD_RAW_ROWS):
         self.id_counter = itertools.count()
 
         self.experiment_name = experiment_name
@@ -42,13 +97,16 @@ class Model:
         self.run_id = run_id
 
         # set up a logger to use - only need one per base_model
-        self.logger = Logger(experiment_name, scenario_name, run_id, scratch_path)
+        self.logger = Logger(experiment_name, scenario_name, run_id, scratch_path, record_rows)
 
         self.step_counter = itertools.count()
         self.current_step = next(self.step_counter)
         self._total_steps = None
         self._total_days = None
 
+        # the model's own random numbers, so they can be snapshotted
+        self.random = random.Random()
+
         # true if the model has started but not ended
         self.started = False
 
@@ -81,47 +139,134 @@ class Model:
         """
         return next(self.id_counter)
 
-    def run(self, total_replications, total_model_steps):
+    def snapshot(self):
+        """
+        Captures the model's state at the current step: step and id counters, random number generator and
+        everything logged so far.
+
+        :return: Snapshot dictionary that restore() can fork a new model from
+        """
+        next_id = next(self.id_counter)
+        self.id_counter = itertools.count(next_id)
+        return {"current_step": self.current_step,
+                "next_id": next_id,
+                "random_state": self.random.getstate(),
+                "logged_rows": self.logger.logged_rows(),
+                "summaries": self.logger.summaries}
+
+    def restore(self, snapshot, reseed=True):
+        """
+        Forks this model from a snapshot of another, logging the snapshot's rows as this model's own.
+
+        :param snapshot: Snapshot from snapshot()
+        :param reseed: Reseed the random number generator so this model diverges from the others forked from the
+                       same snapshot
+        """
+        self.current_step = snapshot["current_step"]
+        self.step_counter = itertools.count(self.current_step + 1)
+        self.id_counter = itertools.count(snapshot["next_id"])
+        self.random.setstate(snapshot["random_state"])
+        if reseed:
+            self.random.seed()
+        self.logger.restore_rows(snapshot["logged_rows"])
+        # the same snapshot can be restored by other models in this worker, so it isn't changed
+        self.logger.summaries = copy.deepcopy(snapshot["summaries"])
+
+    def run(self, total_replications, total_model_steps, snapshot=None):
         """
         Run the base_model. Calls start(), then step() until done, then end()
 
         :param total_replications: Total number of replications of this scenario (just for friendly prints)
         :param total_model_steps: Total number of steps to run the model
+        :param snapshot: Snapshot of the scenario's warm-up (see warm_up()) to fork from, or None to run from the
+                         start
         """
         self.total_steps = total_model_steps
 
         self.start(total_replications)
+        if snapshot is not None:
+            self.restore(snapshot)
         self.run_to_step()
         if self.started:
             self.end()
-        return copy.deepcopy(self.logger.db_filepath), copy.deepcopy(self.logger.tables)
+        return copy.deepcopy(self.logger.db_filepath), copy.deepcopy(self.logger.tables), self.logger.summaries
+
+    async def run_async(self, total_replications, total_model_steps, snapshot=None):
+        """
+        Run the base_model as a coroutine, so other models can run on the same event loop while this one waits.
+        Calls start(), then steps until done, then end()
+
+        :param total_replications: Total number of replications of this scenario (just for friendly prints)
+        :param total_model_steps: Total number of steps to run the model
+        :param snapshot: Snapshot of the scenario's warm-up to fork from, or None to run from the start (see run())
+        """
+        self.total_steps = total_model_steps
+
+        self.start(total_replications)
+        if snapshot is not None:
+            # restoring writes the warm-up's rows to the DB, so it's done off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.restore, snapshot)
+        await self.run_to_step_async()
+        if self.started:
+            await asyncio.get_running_loop().run_in_executor(None, self.end)
+        return copy.deepcopy(self.logger.db_filepath), copy.deepcopy(self.logger.tables), self.logger.summaries
 
     def start(self, total_runs):
         # print("start {}:{}:{}  total={} ({})".format(self.experiment_name, self.scenario_name, self.run_id, total_runs,
         #                                              datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         self.started = True
 
-    def run_to_step(self, end_step=None):
+    def steps(self, end_step=None):
         """
-        Run the model for a set number of steps.
+        The model's steps, shared by run_to_step() and run_to_step_async(). The step counter is incremented when
+        the next step is asked for. Stops early (from the first step, and then every STOP_CHECK_SECONDS) if
+        training has stopped.
 
         :param end_step: Step to end on. Defaults to the total steps.
+        :return: Generator of (time to wait for in seconds, info to log: (info_type, info_string, timestamp, value))
+                 for each step
         """
         info_types = ["count", "resistance", "treatments"]
 
         if end_step is None:
             end_step = self.total_steps
+        next_stop_check = time.time()
         while self.current_step < end_step and self.started:
-            # sleep for a random time 50-200 milliseconds
-            sleep_time = random.uniform(.05, .2)
-            time.sleep(sleep_time)
+            if time.time() >= next_stop_check:
+                if training_stopped():
+                    break
+                next_stop_check = time.time() + STOP_CHECK_SECONDS
+
+            # a random time 50-200 milliseconds
+            sleep_time = self.random.uniform(*STEP_SECONDS_RANGE)
 
-            # log something to the database
-            self.logger.log_info(random.choice(info_types), "test", self.current_step, random.randint(10, 1000))
+            # something to log to the database
+            yield sleep_time, (self.random.choice(info_types), "test", self.current_step,
+                               self.random.randint(10, 1000))
 
             # increment the step
             self.current_step = next(self.step_counter)
 
+    def run_to_step(self, end_step=None):
+        """
+        Run the model for a set number of steps.
+
+        :param end_step: Step to end on. Defaults to the total steps.
+        """
+        for sleep_time, info in self.steps(end_step):
+            time.sleep(sleep_time)
+            self.logger.log_info(*info)
+
+    async def run_to_step_async(self, end_step=None):
+        """
+        Run the model for a set number of steps, yielding to the event loop while waiting.
+
+        :param end_step: Step to end on. Defaults to the total steps.
+        """
+        for sleep_time, info in self.steps(end_step):
+            await asyncio.sleep(sleep_time)
+            await self.logger.log_info_async(*info)
+
     def end(self):
         """
         Stop the model running. Closes everything safely.
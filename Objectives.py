@@ -0,0 +1,143 @@
+import math
+import json
+
+import numpy as np
+
+from Experiment import Experiment
+from config import REPLICATIONS, NUM_SCENARIOS, OUTPUT_DIR, MODELS_PER_WORKER, WARMUP_STEPS, RECORD_RAW_ROWS, \
+    TARGET_OUTPUTS, MODEL_MEMORY_GB
+
+
+# {objective_name: (function, is_cheap, model_runs_per_evaluation)}
+OBJECTIVES = {}
+
+
+def register_objective(name, cheap=True, model_runs=0):
+    """
+    Decorator that adds an objective function to the registry.
+
+    An objective takes an N x D array of positions (one row per particle, columns in sorted parameter name order)
+    and returns an array of N scores. Lower scores are better.
+
+    :param name: Name used to look the objective up (e.g. from the command line)
+    :param cheap: True if the objective is quick to evaluate, so many evaluations can be batched into one task
+    :param model_runs: Number of model runs each evaluation costs (for model run budgets)
+    """
+    def decorator(function):
+        OBJECTIVES[name] = (function, cheap, model_runs)
+        return function
+    return decorator
+
+
+def is_cheap_objective(name):
+    return OBJECTIVES[name][1]
+
+
+def objective_model_runs(name):
+    return OBJECTIVES[name][2]
+
+
+def evaluate_objective(name, positions, **kwargs):
+    """
+    Scores a batch of positions with a registered objective in a single call.
+
+    :param name: Name of the registered objective
+    :param positions: N x D array-like of positions
+    :param kwargs: Extra information passed through to the objective (e.g. experiment names for experiment scoring)
+    :return: Array of N scores
+    """
+    function = OBJECTIVES[name][0]
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    return np.asarray(function(positions, **kwargs), dtype=float)
+
+
+@register_objective("ackley")
+def ackley(positions, **kwargs):
+    """
+    Ackley function, generalised to D dimensions. Global minimum of 0 at the origin.
+    """
+    dimensions = positions.shape[1]
+    sum_squares = np.sum(positions ** 2, axis=1) / dimensions
+    sum_cos = np.sum(np.cos(2 * math.pi * positions), axis=1) / dimensions
+    return -20 * np.exp(-.2 * np.sqrt(sum_squares)) - np.exp(sum_cos) + math.e + 20
+
+
+@register_objective("rastrigin")
+def rastrigin(positions, **kwargs):
+    """
+    Rastrigin function. Global minimum of 0 at the origin.
+    """
+    dimensions = positions.shape[1]
+    return 10 * dimensions + np.sum(positions ** 2 - 10 * np.cos(2 * math.pi * positions), axis=1)
+
+
+@register_objective("rosenbrock")
+def rosenbrock(positions, **kwargs):
+    """
+    Rosenbrock function. Global minimum of 0 at (1, 1, ...).
+    """
+    current = positions[:, :-1]
+    following = positions[:, 1:]
+    return np.sum(100 * (following - current ** 2) ** 2 + (1 - current) ** 2, axis=1)
+
+
+def load_targets(targets_path):
+    """
+    Reads the target output means the experiment objective is scored against from a JSON file.
+
+    :param targets_path: Path of a JSON file of target means: {info_type: target}
+    :return: Dictionary of target means: {info_type: target}
+    """
+    with open(targets_path) as targets_file:
+        targets = json.load(targets_file)
+
+    # without any targets the experiment's outputs wouldn't count towards its score
+    if not isinstance(targets, dict) or len(targets) == 0:
+        raise ValueError("{} has no target outputs - expected {{info_type: target mean, ...}}".format(targets_path))
+    return {info_type: float(target) for info_type, target in targets.items()}
+
+
+def output_error(aggregates, targets=TARGET_OUTPUTS):
+    """
+    Squared error between the mean model outputs and their targets, summed over scenarios and output types.
+
+    :param aggregates: Summary statistics of an experiment: {(scenario_name, info_type): SummaryStatistics}
+    :param targets: Target mean for each output type: {info_type: target}. Types without a target are ignored.
+    :return: The total error
+    """
+    error = 0.0
+    for (scenario_name, info_type), summary in aggregates.items():
+        if info_type in targets and summary.count > 0:
+            error += (summary.mean - targets[info_type]) ** 2
+    return error
+
+
+@register_objective("experiment", cheap=False, model_runs=REPLICATIONS * NUM_SCENARIOS)
+def experiment_score(positions, experiment_names=None, scratch_path=OUTPUT_DIR, models_per_worker=MODELS_PER_WORKER,
+                     warmup_steps=WARMUP_STEPS, record_rows=RECORD_RAW_ROWS, model_memory_gb=MODEL_MEMORY_GB,
+                     targets=TARGET_OUTPUTS, **kwargs):
+    """
+    Runs a full experiment for every position, then scores it.
+
+    :param experiment_names: One experiment name per position (required)
+    :param scratch_path: Location for the experiment's model databases
+    :param models_per_worker: Number of models co-scheduled on an event loop in each task
+    :param warmup_steps: Steps shared by all replications of a scenario, run once and forked from a snapshot
+    :param record_rows: False to only keep summary statistics of the model outputs
+    :param model_memory_gb: Memory each model run declares it needs in GB
+    :param targets: Target mean for each output type the experiments are scored against: {info_type: target}
+    """
+    output_errors = []
+    for experiment_name in experiment_names:
+        experiment = Experiment(experiment_name, REPLICATIONS, scratch_path, models_per_worker, warmup_steps,
+                                record_rows, model_memory_gb)
+
+        # add a bunch of scenarios (only the scenario count has any impact
+        for i in range(NUM_SCENARIOS):
+            experiment.add_scenario("s_{}".format(i), {"foo": "bar", "baz": 4})
+
+        # run the experiment, scoring from the output summaries
+        output_errors.append(output_error(experiment.run_experiment(), targets))
+
+    # the test model's outputs don't depend on the position, so Ackley stands in for how well it fits
+    return ackley(positions) + np.array(output_errors)
@@ -0,0 +1,118 @@
+import shutil
+
+from config import MEMORY_RESOURCE, MERGE_RESOURCE, MODEL_MEMORY_GB, MODEL_SCRATCH_GB, MERGE_SLOTS_PER_WORKER
+
+
+def worker_resources(memory_gb):
+    """
+    Works out the resources each worker in the cluster advertises to the scheduler.
+
+    :param memory_gb: Memory per worker in GB
+    :return: Dictionary of resources for each worker: {resource_name: amount}
+    """
+    return {MEMORY_RESOURCE: memory_gb,
+            MERGE_RESOURCE: MERGE_SLOTS_PER_WORKER}
+
+
+def check_worker_memory(memory_gb, model_memory_gb=MODEL_MEMORY_GB):
+    """
+    Checks a worker has enough memory for a model run, so a cluster that can never run a model fails when it's set
+    up instead of once training has started.
+
+    :param memory_gb: Memory per worker in GB
+    :param model_memory_gb: Memory each model run needs in GB
+    """
+    if memory_gb < model_memory_gb:
+        raise ValueError("a model run needs {} GB of memory but each worker only has {} GB - give the workers more "
+                         "memory (or fewer workers), or lower the memory per model".format(model_memory_gb,
+                                                                                           memory_gb))
+
+
+def models_per_task(dask_client, models_per_worker, model_memory_gb=MODEL_MEMORY_GB):
+    """
+    Number of models to co-schedule in each task: models_per_worker, reduced until the task's memory fits on the
+    largest worker.
+
+    :param dask_client: Client connected to the cluster the tasks will run on
+    :param models_per_worker: Number of models wanted in each task
+    :param model_memory_gb: Memory each model run needs in GB
+    :return: Number of models to put in each task
+    """
+    largest_memory = _largest_resources(dask_client).get(MEMORY_RESOURCE)
+    if largest_memory is None:
+        return models_per_worker
+    return max(min(models_per_worker, int(largest_memory // model_memory_gb)), 1)
+
+
+def model_resources(dask_client, num_models=1, model_memory_gb=MODEL_MEMORY_GB):
+    """
+    Resources needed by a task running one or more models.
+
+    :param dask_client: Client connected to the cluster the task will run on
+    :param num_models: Number of models the task runs at the same time
+    :param model_memory_gb: Memory each model run needs in GB
+    :return: Dictionary of resources to pass to submit()
+    """
+    return _available_resources(dask_client, {MEMORY_RESOURCE: model_memory_gb * num_models})
+
+
+def merge_resources(dask_client):
+    """
+    Resources needed by a task merging model databases.
+
+    :param dask_client: Client connected to the cluster the task will run on
+    :return: Dictionary of resources to pass to submit()
+    """
+    return _available_resources(dask_client, {MERGE_RESOURCE: 1})
+
+
+def evaluations_on_disk(scratch_path, model_runs, scratch_gb=None):
+    """
+    Number of evaluations whose model databases fit on the scratch disk at once. A model database stays on the disk
+    from when its model run starts until the experiment's raw rows are merged, so this is limited by training
+    (counting the evaluations running or merging) rather than by a worker resource freed when the model run ends.
+
+    :param scratch_path: Location model databases are written to
+    :param model_runs: Number of model runs (databases) in each evaluation
+    :param scratch_gb: Scratch disk to use in GB (defaults to the free space)
+    :return: Maximum number of evaluations, or None if evaluations don't write model databases
+    """
+    if model_runs == 0:
+        return None
+    if scratch_gb is None:
+        scratch_gb = shutil.disk_usage(scratch_path).free / 10 ** 9
+
+    evaluation_gb = model_runs * MODEL_SCRATCH_GB
+    if evaluation_gb > scratch_gb:
+        raise ValueError("an evaluation needs {} GB of scratch disk but there is only {} GB".format(evaluation_gb,
+                                                                                                   scratch_gb))
+    return int(scratch_gb // evaluation_gb)
+
+
+def _largest_resources(dask_client):
+    """
+    The most of each resource any one worker in the cluster has: {resource_name: amount}
+    """
+    largest = {}
+    for worker in dask_client.scheduler_info()["workers"].values():
+        for name, amount in worker.get("resources", {}).items():
+            largest[name] = max(amount, largest.get(name, 0))
+    return largest
+
+
+def _available_resources(dask_client, needed):
+    """
+    Restricts resource needs to those the cluster's workers advertise (so tasks still run on a cluster without
+    them). A need bigger than the largest worker could never be met, so it's an error rather than a task left
+    waiting forever.
+    """
+    largest = _largest_resources(dask_client)
+
+    resources = {}
+    for name, amount in needed.items():
+        if name not in largest:
+            continue
+        if amount > largest[name]:
+            raise ValueError("task needs {} {} but workers only have {}".format(amount, name, largest[name]))
+        resources[name] = amount
+    return resources
@@ -0,0 +1,378 @@
+from datetime import timedelta
+import argparse
+import heapq
+import itertools
+import math
+import random
+
+from psoTrain import next_particles
+from Resources import evaluations_on_disk
+from config import NUM_PARTICLES, ITERATIONS, REPLICATIONS, NUM_SCENARIOS, MODELS_PER_WORKER, MODEL_STEPS_RANGE, \
+    STEP_SECONDS_RANGE, PARTICLE_TASK_SECONDS, WARMUP_STEPS, RECORD_RAW_ROWS, MERGE_SLOTS_PER_WORKER, \
+    MERGE_SECONDS_PER_MODEL_RUN
+
+
+POLICIES = ["fifo", "longest_first"]
+
+
+class SimulatedEvaluation:
+    """
+    One particle evaluation (an experiment) in the simulation.
+    """
+
+    def __init__(self, particle, epoch, dispatched, triggered_by):
+        self.particle = particle
+        self.epoch = epoch
+        self.dispatched = dispatched
+        # the evaluation whose completion dispatched this one (None for the first wave)
+        self.triggered_by = triggered_by
+
+        self.tasks_left = 0
+        self.last_task = None
+        self.finished = None
+
+
+class SimulatedTask:
+    """
+    A task holding a core: a particle task (until it secedes), a scenario's warm-up, a group of model runs or an
+    experiment's raw row merge (which also holds a merge slot).
+    """
+
+    def __init__(self, evaluation, duration, kind, waiting_for=()):
+        self.evaluation = evaluation
+        self.duration = duration
+        self.kind = kind  # "particle", "warmup", "model" or "merge"
+        self.priority = None
+        self.submitted = None
+        self.started = None
+
+        # tasks whose results this one needs, and the tasks waiting for this one
+        self.waiting_for = set(waiting_for)
+        self.dependents = []
+        for task in self.waiting_for:
+            task.dependents.append(self)
+
+
+class SchedulingSimulator:
+    """
+    Discrete-event simulation of Train.solve on a fixed number of cores, for capacity planning.
+
+    Particles are dispatched as in Train.solve (the fewest epochs done first, as each evaluation finishes, as many as
+    fit on the scratch disk if that's limited). Each evaluation is a particle task that holds a core briefly then
+    secedes, fanning out as in Experiment.run_experiment: a warm-up task for every scenario (if there are warm-up
+    steps), and a model task for every scenario replication (grouped models_per_worker to a task), which waits for
+    its scenario's warm-up. Once the models finish, the evaluation is done and its raw rows are merged (if they're
+    recorded) by a task holding a core and a merge slot. Tasks queue for free cores in the order given by the
+    policy.
+    """
+
+    def __init__(self, num_cores, num_particles=NUM_PARTICLES, iterations=ITERATIONS, replications=REPLICATIONS,
+                 num_scenarios=NUM_SCENARIOS, models_per_worker=MODELS_PER_WORKER, policy="fifo", durations=None,
+                 seed=None, warmup_steps=WARMUP_STEPS, record_rows=RECORD_RAW_ROWS, max_evaluations_on_disk=None,
+                 threads_per_worker=1, particle_task_seconds=PARTICLE_TASK_SECONDS,
+                 merge_seconds_per_run=MERGE_SECONDS_PER_MODEL_RUN):
+        """
+        :param num_cores: Number of cores (worker threads)
+        :param policy: Order queued tasks start in: "fifo" (submission order, like dask) or "longest_first"
+        :param durations: Recorded model run durations in seconds to sample from. Defaults to modelling them from
+                          MODEL_STEPS_RANGE and STEP_SECONDS_RANGE.
+        :param seed: Random seed, for repeatable predictions
+        :param warmup_steps: Steps shared by the replications of a scenario, run once in a warm-up task
+        :param record_rows: True if the raw rows are recorded, so each evaluation ends with a merge task
+        :param max_evaluations_on_disk: Evaluations whose model DBs fit on the scratch disk at once (None for no
+                                        limit, see Resources.evaluations_on_disk). Only limits recorded raw rows.
+        :param threads_per_worker: Threads in each worker (each worker has MERGE_SLOTS_PER_WORKER merge slots)
+        :param particle_task_seconds: Time a particle task holds a core before seceding
+        :param merge_seconds_per_run: Time a merge takes for each model DB
+        """
+        self.num_cores = num_cores
+        self.num_particles = num_particles
+        self.iterations = iterations
+        self.replications = replications
+        self.num_scenarios = num_scenarios
+        self.models_per_worker = models_per_worker
+        self.policy = policy
+        self.durations = durations
+        self.random = random.Random(seed)
+        self.warmup_steps = warmup_steps
+        self.record_rows = record_rows
+        self.max_evaluations_on_disk = max_evaluations_on_disk if record_rows else None
+        self.particle_task_seconds = particle_task_seconds
+        self.merge_seconds_per_run = merge_seconds_per_run
+
+        self.time = 0.0
+        self.free_cores = num_cores
+        self.free_merge_slots = max(num_cores // threads_per_worker, 1) * MERGE_SLOTS_PER_WORKER
+        self.busy_time = 0.0
+        self.sequence = itertools.count()
+        self.queue = []  # [(priority, task), ...]
+        self.events = []  # [(finish time, sequence, task), ...]
+
+        self.particles_running = [False] * num_particles
+        self.particle_epochs_completed = [0] * num_particles
+        self.last_evaluation = None
+        self.evaluations = 0
+        self.merging = 0
+        self.task_counts = {"particle": 0, "warmup": 0, "model": 0, "merge": 0}
+
+    def model_duration(self, total_steps, steps=None):
+        """
+        Time for some of the steps of a model run: a recorded run duration scaled to the steps, or the sum of the
+        steps' uniform step times (approximated by a normal distribution).
+
+        :param total_steps: Number of steps in the whole model run
+        :param steps: Number of steps to time. Defaults to the whole run.
+        """
+        if steps is None:
+            steps = total_steps
+        if self.durations:
+            return self.random.choice(self.durations) * steps / total_steps
+        low, high = STEP_SECONDS_RANGE
+        mean = steps * (low + high) / 2
+        deviation = math.sqrt(steps * (high - low) ** 2 / 12)
+        return max(self.random.gauss(mean, deviation), 0.0)
+
+    def submit(self, task):
+        """
+        Submits a task, which queues for a core once the tasks it's waiting for have finished. Its place in the
+        queue is set when it's submitted, as dask's priorities are.
+        """
+        task.submitted = self.time
+        if self.policy == "longest_first":
+            task.priority = (task.kind != "particle", -task.duration, next(self.sequence))
+        else:
+            task.priority = (0, 0, next(self.sequence))
+        if len(task.waiting_for) == 0:
+            heapq.heappush(self.queue, (task.priority, task))
+
+    def start_tasks(self):
+        # merges that can't get a merge slot stay queued without holding up the tasks behind them
+        blocked = []
+        while self.free_cores > 0 and len(self.queue) > 0:
+            priority, task = heapq.heappop(self.queue)
+            if task.kind == "merge":
+                if self.free_merge_slots == 0:
+                    blocked.append((priority, task))
+                    continue
+                self.free_merge_slots -= 1
+            task.started = self.time
+            self.free_cores -= 1
+            heapq.heappush(self.events, (self.time + task.duration, next(self.sequence), task))
+        for item in blocked:
+            heapq.heappush(self.queue, item)
+
+    def dispatch_count(self, finished):
+        """
+        Number of particles to start now, as Train.dispatch_count.
+
+        :param finished: Number of evaluations that just finished
+        """
+        if self.max_evaluations_on_disk is None:
+            return finished
+        return max(self.max_evaluations_on_disk - sum(self.particles_running) - self.merging, 0)
+
+    def dispatch(self, count, triggered_by):
+        for particle in next_particles(self.particles_running, self.particle_epochs_completed, self.iterations,
+                                       count):
+            self.particles_running[particle] = True
+            evaluation = SimulatedEvaluation(particle, self.particle_epochs_completed[particle], self.time,
+                                             triggered_by)
+            self.submit(SimulatedTask(evaluation, self.particle_task_seconds, "particle"))
+
+    def fan_out(self, evaluation):
+        """
+        Submits the warm-up and model tasks of an evaluation's experiment.
+        """
+        # [(duration, warm-up task or None), ...] for each model run, in scenario order
+        model_runs = []
+        for _ in range(self.num_scenarios):
+            total_steps = self.random.randint(*MODEL_STEPS_RANGE)
+            warmup_steps = min(self.warmup_steps, total_steps)
+            warmup = None
+            if warmup_steps > 0:
+                warmup = SimulatedTask(evaluation, self.model_duration(total_steps, warmup_steps), "warmup")
+                self.submit(warmup)
+            model_runs.extend((self.model_duration(total_steps, total_steps - warmup_steps), warmup)
+                              for _ in range(self.replications))
+
+        for group_start in range(0, len(model_runs), self.models_per_worker):
+            # co-scheduled models wait together, so a group takes as long as its longest model (and starts once
+            # all of their warm-ups are done)
+            group = model_runs[group_start:group_start + self.models_per_worker]
+            self.submit(SimulatedTask(evaluation, max(duration for duration, _ in group), "model",
+                                      [warmup for _, warmup in group if warmup is not None]))
+            evaluation.tasks_left += 1
+
+        if evaluation.tasks_left == 0:
+            self.finish(evaluation)
+
+    def finish(self, evaluation):
+        evaluation.finished = self.time
+        self.last_evaluation = evaluation
+        self.evaluations += 1
+        self.particles_running[evaluation.particle] = False
+        self.particle_epochs_completed[evaluation.particle] += 1
+
+        # the experiment hands its raw rows to a merge without waiting for it
+        if self.record_rows:
+            self.merging += 1
+            self.submit(SimulatedTask(evaluation, self.merge_seconds_per_run * self.num_scenarios *
+                                      self.replications, "merge"))
+
+        self.dispatch(self.dispatch_count(1), evaluation)
+
+    def run(self):
+        """
+        Simulates the whole training run.
+
+        :return: Dictionary with the predicted "wall_time" (seconds), "idle_fraction" of core time, number of
+                 "evaluations", "task_counts" of each kind of task, and the "critical_path" (list of evaluations,
+                 first to last)
+        """
+        self.dispatch(self.dispatch_count(self.num_particles), None)
+        self.start_tasks()
+
+        while len(self.events) > 0:
+            self.time, _, task = heapq.heappop(self.events)
+            self.free_cores += 1
+            self.busy_time += task.duration
+            self.task_counts[task.kind] += 1
+
+            for dependent in task.dependents:
+                dependent.waiting_for.discard(task)
+                if len(dependent.waiting_for) == 0:
+                    heapq.heappush(self.queue, (dependent.priority, dependent))
+
+            evaluation = task.evaluation
+            if task.kind == "particle":
+                # the particle task secedes and runs its experiment
+                self.fan_out(evaluation)
+            elif task.kind == "model":
+                evaluation.tasks_left -= 1
+                evaluation.last_task = task
+                if evaluation.tasks_left == 0:
+                    self.finish(evaluation)
+            elif task.kind == "merge":
+                # the merge frees its slot and the evaluation's scratch disk
+                self.free_merge_slots += 1
+                self.merging -= 1
+                self.dispatch(self.dispatch_count(0), evaluation)
+            self.start_tasks()
+
+        idle_fraction = 0.0
+        if self.time > 0:
+            idle_fraction = 1 - self.busy_time / (self.num_cores * self.time)
+
+        return {"wall_time": self.time,
+                "idle_fraction": idle_fraction,
+                "evaluations": self.evaluations,
+                "task_counts": self.task_counts,
+                "critical_path": self.critical_path()}
+
+    def critical_path(self):
+        """
+        The chain of evaluations that ends the run: the last evaluation, the one whose completion dispatched it,
+        and so on back to the first wave.
+        """
+        path = []
+        evaluation = self.last_evaluation
+        while evaluation is not None:
+            path.append(evaluation)
+            evaluation = evaluation.triggered_by
+        path.reverse()
+        return path
+
+
+def report(result, num_cores):
+    """
+    Prints the predictions from a simulation.
+    """
+    path = result["critical_path"]
+    print("predicted wall time: {} ({} s)".format(timedelta(seconds=round(result["wall_time"])),
+                                                  round(result["wall_time"])))
+    print("idle core fraction: {}".format(round(result["idle_fraction"], 3)))
+    task_counts = result["task_counts"]
+    print("evaluations: {}, model tasks: {}, warm-up tasks: {}, merge tasks: {}, cores: {}".format(
+        result["evaluations"], task_counts["model"], task_counts["warmup"], task_counts["merge"], num_cores))
+
+    queued = sum(evaluation.last_task.started - evaluation.last_task.submitted
+                 for evaluation in path if evaluation.last_task is not None)
+    running = sum(evaluation.last_task.duration for evaluation in path if evaluation.last_task is not None)
+    print("critical path: {} evaluations, last model tasks {} s running + {} s queued".format(
+        len(path), round(running), round(queued)))
+    for evaluation in path:
+        task = evaluation.last_task
+        print("  particle {} epoch {}: {} - {} s{}".format(
+            evaluation.particle, evaluation.epoch, round(evaluation.dispatched), round(evaluation.finished),
+            "" if task is None else " (last task queued {} s, ran {} s)".format(
+                round(task.started - task.submitted), round(task.duration))))
+
+
+def read_durations(durations_path):
+    """
+    Reads recorded model run durations: one time in seconds per line (blank lines and # comments ignored).
+    """
+    durations = []
+    with open(durations_path) as durations_file:
+        for line in durations_file:
+            line = line.split("#")[0].strip()
+            if line:
+                durations.append(float(line))
+    return durations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Predict the wall time and utilisation of a training run.')
+    parser.add_argument('-c', '--cpus', type=int, default=32,
+                        help='Cores to simulate (default: 32)')
+    parser.add_argument('-p', '--particles', type=int, default=NUM_PARTICLES,
+                        help='Number of particles (default: {})'.format(NUM_PARTICLES))
+    parser.add_argument('-i', '--iterations', type=int, default=ITERATIONS,
+                        help='Iterations for each particle (default: {})'.format(ITERATIONS))
+    parser.add_argument('-r', '--replications', type=int, default=REPLICATIONS,
+                        help='Replications of each scenario (default: {})'.format(REPLICATIONS))
+    parser.add_argument('-s', '--scenarios', type=int, default=NUM_SCENARIOS,
+                        help='Scenarios in each experiment (default: {})'.format(NUM_SCENARIOS))
+    parser.add_argument('--models-per-worker', type=int, default=MODELS_PER_WORKER,
+                        help='Models co-scheduled in each task (default: {})'.format(MODELS_PER_WORKER))
+    parser.add_argument('--policy', choices=POLICIES, default=None,
+                        help='Order queued tasks start in (default: compare all)')
+    parser.add_argument('-d', '--durations', default=None,
+                        help='File of recorded model run durations in seconds, one per line')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed')
+    parser.add_argument('-t', '--threads-per-worker', type=int, default=1,
+                        help='Threads in each worker, for the number of merge slots (default: 1)')
+    parser.add_argument('-w', '--warmup-steps', type=int, default=WARMUP_STEPS,
+                        help='Steps shared by the replications of a scenario (default: {})'.format(WARMUP_STEPS))
+    parser.add_argument('--no-raw-rows', dest='record_rows', action='store_false', default=RECORD_RAW_ROWS,
+                        help='Only keep summary statistics, without merging the raw rows')
+    parser.add_argument('--scratch-gb', type=float, default=None,
+                        help='Scratch disk for model databases in GB, limiting the evaluations dispatched at once '
+                             '(default: no limit)')
+    parser.add_argument('--particle-task-seconds', type=float, default=PARTICLE_TASK_SECONDS,
+                        help='Time a particle task holds a core before seceding (default: {})'.format(
+                            PARTICLE_TASK_SECONDS))
+    parser.add_argument('--merge-seconds-per-run', type=float, default=MERGE_SECONDS_PER_MODEL_RUN,
+                        help='Time a raw row merge takes for each model database (default: {})'.format(
+                            MERGE_SECONDS_PER_MODEL_RUN))
+
+    args = parser.parse_args()
+
+    recorded_durations = read_durations(args.durations) if args.durations is not None else None
+    max_evaluations = None
+    if args.scratch_gb is not None:
+        max_evaluations = evaluations_on_disk(None, args.replications * args.scenarios, args.scratch_gb)
+
+    print("not simulated: worker memory limits, scheduler and transfer overheads, restoring warm-up snapshots")
+    if args.scratch_gb is None:
+        print("scratch disk not limited (pass --scratch-gb to limit the evaluations dispatched at once)")
+
+    for policy in [args.policy] if args.policy is not None else POLICIES:
+        print("=== policy: {} ===".format(policy))
+        simulator = SchedulingSimulator(args.cpus, args.particles, args.iterations, args.replications,
+                                        args.scenarios, args.models_per_worker, policy, recorded_durations,
+                                        args.seed, args.warmup_steps, args.record_rows, max_evaluations,
+                                        args.threads_per_worker, args.particle_task_seconds,
+                                        args.merge_seconds_per_run)
+        report(simulator.run(), args.cpus)
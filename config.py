@@ -13,8 +13,78 @@ REPLICATIONS = 5
 NUM_PARTICLES = 15
 NUM_SCENARIOS = 10
 
+# worker resources declared to the dask scheduler, and what tasks need of them
+MEMORY_RESOURCE = "MEMORY"  # GB
+MERGE_RESOURCE = "MERGE"  # slots for merging model databases
+MODEL_MEMORY_GB = .5  # per model run (default for --model-memory-gb)
+MERGE_SLOTS_PER_WORKER = 1
+# scratch disk per model run database in GB. Databases are kept until the experiment's raw rows are merged, so
+# training limits the evaluations running or merging to what fits on the scratch disk.
+MODEL_SCRATCH_GB = .05
+
+# worker memory management, as fractions of each worker's memory limit
+MEMORY_TARGET = .6  # start spilling to disk
+MEMORY_SPILL = .7  # spill based on process memory
+MEMORY_PAUSE = .8  # stop running new tasks
+MEMORY_TERMINATE = .95  # restart the worker
+
+# auto-tuning of the cluster topology
+TOPOLOGY_PATH = os.path.join(OUTPUT_DIR, "cluster_topology.json")  # settings chosen for each workload
+CALIBRATION_STEPS = 20  # steps in each calibration model run
+CALIBRATION_RUNS_PER_CPU = 2  # calibration model runs for each core
+CALIBRATION_REPEATS = 3  # timed measurements of each topology (the median is used)
+TOPOLOGY_MARGIN = .1  # fraction a topology's throughput must beat the default topology's by to be chosen instead
+
+# warm-up steps shared by every replication of a scenario (run once and forked from a snapshot, 0 to disable)
+WARMUP_STEPS = 0
+
+# write every raw logged row to the model DBs (and gather them into an experiment DB) as well as keeping
+# summary statistics of the outputs
+RECORD_RAW_ROWS = True
+# values kept at each level of the quantile sketches in output summaries
+QUANTILE_SKETCH_CAPACITY = 200
+# observed output means the training is scored against: {info_type: target mean}. These defaults are the test
+# model's expected means (its logged values are uniform between 10 and 1000) - load observed ones with --targets
+TARGET_OUTPUTS = {"count": 505, "resistance": 505, "treatments": 505}
+
+# name of the dask queue experiments pass the futures of their raw row merges to training on, so training can
+# wait for them to finish
+MERGE_QUEUE_NAME = "raw_row_merges"
+
+# number of models co-scheduled on one event loop in each task (1 to run each model in its own task). This is per
+# task, not per worker: a worker runs as many of these tasks at once as its threads and MEMORY resource allow.
+MODELS_PER_WORKER = 1
+# number of rows an async logger buffers before writing them to its database
+LOG_BUFFER_SIZE = 50
+
+# test model run lengths: steps per scenario, and the time each step takes
+MODEL_STEPS_RANGE = (300, 700)
+STEP_SECONDS_RANGE = (.05, .2)
+
+# capacity planning simulator (Simulator.py)
+PARTICLE_TASK_SECONDS = .5  # time a particle task holds a core before seceding to run its experiment
+MERGE_SECONDS_PER_MODEL_RUN = .01  # time a raw row merge takes for each model DB it gathers
+
+# objective used to score particle positions (see Objectives.py)
+OBJECTIVE = "experiment"
+# number of particle evaluations to put in a single task when the objective is cheap
+CHEAP_BATCH_SIZE = 256
+
+# early stopping criteria (None to disable)
+STALL_EVALUATIONS = None  # evaluations without a global best improvement
+MIN_SWARM_DIAMETER = None  # diagonal of the bounding box around all particle positions
+MAX_HOURS = None  # wall-clock budget
+MAX_MODEL_RUNS = None  # model run budget
+STOP_REPORT_PATH = os.path.join(OUTPUT_DIR, "training_stop_report.txt")
+# name of the dask event training sets to stop the experiments still running when it stops early
+STOP_EVENT_NAME = "stop_training"
+# how often a running model checks whether training has stopped
+STOP_CHECK_SECONDS = 1
+
 RESULTS_DB_NAME = "particle_{}-training_scores.db"
 RESULTS_DB_PATH = os.path.join(OUTPUT_DIR, RESULTS_DB_NAME)
+# cheap objectives record every particle's scores in one DB, written a batch at a time
+BATCH_RESULTS_DB_PATH = os.path.join(OUTPUT_DIR, "particle_batches-training_scores.db")
 RESULTS_TABLE_NAME = "Results"
 ITERATION_COLUMN_NAME = "iteration"
 PARTICLE_COLUMN_NAME = "particle"
@@ -22,6 +92,9 @@ POSITION_COLUMN_NAME = "position"
 VELOCITY_COLUMN_NAME = "velocity"
 SCORE_COLUMN_NAME = "score"
 
+# threads used to read particle score DBs when resuming training
+RESUME_READ_THREADS = 16
+
 # PSO parameters
 INERTIA = .8
 COGNITIVE = 2.8
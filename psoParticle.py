@@ -3,16 +3,16 @@ import random
 import sys
 import pickle
 import sqlite3
-import math
 from collections import defaultdict
 import copy
 import shutil
 import os
 
-from Experiment import Experiment
-from config import SLURM_TMPDIR_STRING, REPLICATIONS, RESULTS_DB_PATH, RESULTS_TABLE_NAME, \
+from HelpFunctions import error_print
+from Objectives import evaluate_objective, is_cheap_objective, objective_model_runs
+from config import SLURM_TMPDIR_STRING, RESULTS_DB_PATH, RESULTS_TABLE_NAME, BATCH_RESULTS_DB_PATH, \
     RESULTS_DB_NAME, ITERATION_COLUMN_NAME, VELOCITY_COLUMN_NAME, PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME, \
-    SCORE_COLUMN_NAME, OUTPUT_DIR, COGNITIVE, SOCIAL, CONSTRICTION, NUM_SCENARIOS
+    SCORE_COLUMN_NAME, OUTPUT_DIR, COGNITIVE, SOCIAL, CONSTRICTION, OBJECTIVE
 
 
 def take_closest(my_list, my_number):
@@ -36,10 +36,118 @@ def take_closest(my_list, my_number):
     return value
 
 
-def score_particle_position(particle, epoch):
-    print("  score {}, epoch {}".format(particle.name, epoch))
-    score, position, velocity = particle.score_current_position(epoch)
-    return particle.name, score, position, velocity
+def score_particle_positions(particles, epochs, objective_options=None):
+    """
+    Scores the current position of a batch of particles with a single call to their objective.
+    All the particles must use the same objective.
+
+    :param particles: List of particles to score
+    :param epochs: The epoch (iteration) being scored for each particle
+    :param objective_options: Dictionary of extra keyword arguments for the objective
+    :return: List of results, one per particle: [(particle name, best score, position, velocity, model runs), ...]
+    """
+    if len(particles) == 1:
+        print("  score {}, epoch {}".format(particles[0].name, epochs[0]))
+    else:
+        print("  score batch of {}, epochs {}-{}".format(len(particles), min(epochs), max(epochs)))
+    objective = particles[0].objective
+    cheap = is_cheap_objective(objective)
+
+    model_runs = defaultdict(int)
+    to_score = []
+    for particle, epoch in zip(particles, epochs):
+        if particle.position_scored:
+            continue
+
+        # check if we've already scored this position (unlikely but scoring is expensive)
+        previous_score = None if cheap else particle.lookup_score()
+        if previous_score is None:
+            to_score.append((particle, epoch))
+        else:
+            # there is a previous score for this position - use that instead
+            particle.record_score(epoch, previous_score)
+
+    if len(to_score) > 0:
+        # no previous score for these positions - have to work them out
+        options = {"scratch_path": to_score[0][0].tmp_dir}
+        options.update(objective_options or {})
+        scores = evaluate_objective(objective,
+                                    [particle.position_vector() for particle, _ in to_score],
+                                    experiment_names=[particle.experiment_name(epoch) for particle, epoch in to_score],
+                                    **options)
+        if cheap:
+            record_batch_scores([particle for particle, _ in to_score], [epoch for _, epoch in to_score], scores)
+        else:
+            for (particle, epoch), score in zip(to_score, scores):
+                particle.record_score(epoch, float(score))
+        for particle, _ in to_score:
+            model_runs[particle.name] = objective_model_runs(objective)
+
+    return [(particle.name, particle.local_best_score, copy.deepcopy(particle.position),
+             copy.deepcopy(particle.velocity), model_runs[particle.name]) for particle in particles]
+
+
+def record_batch_scores(particles, epochs, scores):
+    """
+    Records the scores for a batch of particles' current positions in the shared batch score DB, using a single
+    connection. Cheap objectives use this instead of a DB per particle, as writing and copying a DB for every
+    particle takes far longer than the scoring.
+
+    :param particles: List of particles scored
+    :param epochs: The epoch (iteration) scored for each particle
+    :param scores: The score for each particle
+    """
+    rows = [(epoch, particle.name, pickle_position_velocity(particle.position),
+             pickle_position_velocity(particle.velocity), float(score))
+            for particle, epoch, score in zip(particles, epochs, scores)]
+
+    new_db = not os.path.exists(BATCH_RESULTS_DB_PATH)
+    with sqlite3.connect(BATCH_RESULTS_DB_PATH, timeout=60) as score_db:
+        if new_db:
+            # (if not exists, as batches in other tasks may be creating it too)
+            create_table_str = """create table if not exists {} 
+                                  ({}, {}, {}, {}, {}, PRIMARY KEY ({}, {}) ON CONFLICT REPLACE)"""
+            create_table_str = create_table_str.format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME,
+                                                       PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME,
+                                                       VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME,
+                                                       PARTICLE_COLUMN_NAME, ITERATION_COLUMN_NAME)
+            score_db.execute(create_table_str)
+
+        insert_command = "insert or replace into {} ({}, {}, {}, {}, {}) values (?, ?, ?, ?, ?)". \
+            format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME, PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME,
+                   VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME)
+        score_db.executemany(insert_command, rows)
+
+    for particle, score in zip(particles, scores):
+        particle.set_score(float(score))
+
+
+def read_batch_scores(num_particles):
+    """
+    Reads the scores recorded in the shared batch score DB in an earlier run.
+
+    :param num_particles: Number of particles in the swarm
+    :return: List of the recorded (iteration, score, pickled position, pickled velocity) for each particle
+    """
+    particles_rows = [[] for _ in range(num_particles)]
+    if not os.path.exists(BATCH_RESULTS_DB_PATH):
+        return particles_rows
+
+    with sqlite3.connect(BATCH_RESULTS_DB_PATH, timeout=60) as score_db:
+        query = "select {}, {}, {}, {}, {} from {}".format(PARTICLE_COLUMN_NAME, ITERATION_COLUMN_NAME,
+                                                           SCORE_COLUMN_NAME, POSITION_COLUMN_NAME,
+                                                           VELOCITY_COLUMN_NAME, RESULTS_TABLE_NAME)
+        try:
+            rows = score_db.execute(query).fetchall()
+        except sqlite3.OperationalError as e:
+            # table doesn't exist so we don't need to do anything
+            error_print("--\nread batch scores\n{}\n--".format(e))
+            return particles_rows
+
+    for row in rows:
+        if row[0] < num_particles:
+            particles_rows[row[0]].append(row[1:])
+    return particles_rows
 
 
 def pickle_position_velocity(dictionary):
@@ -71,43 +179,71 @@ class Particle:
     """
     Particle in a particle swarm optimisation. Has position and velocity. Can work out the error associated with
     a location.
+
+    Particles are cheap to create: the score DB isn't touched until the first score is recorded.
     """
 
-    def __init__(self, particle_name, parameter_ranges):
+    __slots__ = ["name", "parameter_ranges", "objective", "tmp_dir", "tmp_db_path_name", "results_db_path_name",
+                 "position_scored", "position", "velocity", "local_best_position", "local_best_score"]
+
+    def __init__(self, particle_name, parameter_ranges, objective=OBJECTIVE, tmp_dir=None):
         self.name = particle_name
         self.parameter_ranges = parameter_ranges
+        # name of the registered objective used to score positions
+        self.objective = objective
 
-        if SLURM_TMPDIR_STRING[1:] in os.environ:
-            self.tmp_dir = os.environ[SLURM_TMPDIR_STRING[1:]]
-        elif os.path.exists(os.path.join(os.environ["HOME"], "scratch")):
-            self.tmp_dir = os.path.join(os.environ["HOME"], "scratch")
-        else:
-            self.tmp_dir = OUTPUT_DIR
+        self.tmp_dir = tmp_dir if tmp_dir is not None else self.scratch_dir()
 
         self.tmp_db_path_name = os.path.join(self.tmp_dir, RESULTS_DB_NAME.format(self.name))
         self.results_db_path_name = RESULTS_DB_PATH.format(self.name)
 
-        # set up the results db if it doesn't exist
-        with sqlite3.connect(self.tmp_db_path_name, timeout=60) as db:
-            db.execute("PRAGMA journal_mode=TRUNCATE")
-            create_table_str = """create table if not exists {} 
-                                  ({}, {}, {} PRIMARY KEY ON CONFLICT REPLACE, {}, {})"""
-            create_table_str = create_table_str.format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME, PARTICLE_COLUMN_NAME,
-                                                       POSITION_COLUMN_NAME, VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME)
-            db.execute(create_table_str)
-            # print("created results table: {}".format(create_table_str))
-
-        if not os.path.exists(self.results_db_path_name):
-            # make a copy in the results directory
-            shutil.copy(self.tmp_db_path_name, self.results_db_path_name)
-
         # initialise
         self.position_scored = False  # True if the current position has been scored
         self.position, self.velocity = self.random_position_velocity()
 
-        self.local_best_position = copy.deepcopy(self.position)
+        self.local_best_position = dict(self.position)
         self.local_best_score = sys.float_info.max
 
+    @staticmethod
+    def scratch_dir():
+        """
+        The directory for temporary files: SLURM's temp dir if there is one, otherwise ~/scratch or the output dir.
+        """
+        if SLURM_TMPDIR_STRING[1:] in os.environ:
+            return os.environ[SLURM_TMPDIR_STRING[1:]]
+        elif os.path.exists(os.path.join(os.environ["HOME"], "scratch")):
+            return os.path.join(os.environ["HOME"], "scratch")
+        return OUTPUT_DIR
+
+    def read_scores(self):
+        """
+        Reads the scores recorded for this particle in an earlier run, and copies them to the tmp directory so
+        they're used as a cache.
+
+        :return: List of recorded (iteration, score, pickled position, pickled velocity), or None if there is no
+                 readable score DB
+        """
+        if not os.path.exists(self.results_db_path_name):
+            return None
+
+        with sqlite3.connect(self.results_db_path_name) as particle_score_db:
+            particle_score_db.execute("PRAGMA journal_mode=TRUNCATE")
+            query = "select {}, {}, {}, {} from {}".format(ITERATION_COLUMN_NAME, SCORE_COLUMN_NAME,
+                                                           POSITION_COLUMN_NAME, VELOCITY_COLUMN_NAME,
+                                                           RESULTS_TABLE_NAME)
+            try:
+                rows = particle_score_db.execute(query).fetchall()
+            except sqlite3.OperationalError as e:
+                # table doesn't exist so we don't need to do anything
+                error_print("--\nread scores, particle {}\n{}\n--".format(self.name, e))
+                return None
+
+        if not os.path.exists(self.tmp_db_path_name) or \
+                not os.path.samefile(self.tmp_db_path_name, self.results_db_path_name):
+            # make a copy in the tmp directory
+            shutil.copy(self.results_db_path_name, self.tmp_db_path_name)
+        return rows
+
     def update_score_position_velocity(self, score, position, velocity, pickled=False):
         if score < self.local_best_score:
             self.local_best_score = score
@@ -174,72 +310,78 @@ class Particle:
                 self.position[name] = new_val
         self.position_scored = False
 
-    def score_current_position(self, current_iteration):
+    def position_vector(self):
         """
-        Works out the error score for the current position. Sets local_best_score if it's better than the previous best.
+        The current position as a list of values, in sorted parameter name order (one row of an objective's input).
         """
-        if not self.position_scored:
-            pickle_position = pickle_position_velocity(self.position)
-            pickle_velocity = pickle_position_velocity(self.velocity)
-
-            # check if we've already scored this position (unlikely but scoring is expensive)
-            with sqlite3.connect(self.tmp_db_path_name, timeout=60) as score_db:
-                search_command = "select {} from {} where {}=?".format(SCORE_COLUMN_NAME,
-                                                                       RESULTS_TABLE_NAME,
-                                                                       POSITION_COLUMN_NAME)
-                results = score_db.execute(search_command, (pickle_position,)).fetchall()
+        return [self.position[name] for name in sorted(self.position)]
 
-            if len(results) == 0:
-                # no previous score for this position - have to work it out
+    def experiment_name(self, current_iteration):
+        return "p_{}-e_{}".format(self.name, current_iteration)
 
-                # create the experiment
-                print("  starting experiment: p {}, epoch {}".format(self.name, current_iteration))
-                experiment = Experiment("p_{}-e_{}".format(self.name, current_iteration), REPLICATIONS, self.tmp_dir)
-
-                # add a bunch of scenarios (only the scenario count has any impact
-                for i in range(NUM_SCENARIOS):
-                    experiment.add_scenario("s_{}".format(i), {"foo": "bar", "baz": 4})
-
-                # run the experiment
-                result_db_name = experiment.run_experiment()
-                # print("scoring against: {}".format(result_db_name))
-
-                # the experiment results are not important for the score in the test
-                score = self.get_ackley_score()
-            else:
-                # there is a previous score for this position - use that instead
-                score = results[0][0]
-
-            # record the score in the database
-            with sqlite3.connect(self.tmp_db_path_name, timeout=60) as score_db:
-                insert_command = "insert or replace into {} ({}, {}, {}, {}, {}) values (?, ?, ?, ?, ?)".\
-                    format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME, PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME,
-                           VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME)
-                score_db.execute(insert_command, (current_iteration, self.name, pickle_position, pickle_velocity,
-                                                  score))
-
-            # flag that we now have a score for this position
-            self.position_scored = True
+    def lookup_score(self):
+        """
+        Checks if the current position has been scored before.
+        :return: The previous score, or None if there isn't one
+        """
+        if not os.path.exists(self.tmp_db_path_name):
+            # nothing recorded yet
+            return None
+
+        with sqlite3.connect(self.tmp_db_path_name, timeout=60) as score_db:
+            search_command = "select {} from {} where {}=?".format(SCORE_COLUMN_NAME,
+                                                                   RESULTS_TABLE_NAME,
+                                                                   POSITION_COLUMN_NAME)
+            results = score_db.execute(search_command, (pickle_position_velocity(self.position),)).fetchall()
+        if len(results) == 0:
+            return None
+        return results[0][0]
+
+    def set_score(self, score):
+        """
+        Flags the current position as scored. Sets local_best_score if it's better than the previous best.
+        """
+        self.position_scored = True
 
-            if score < self.local_best_score:
-                self.local_best_score = score
-                self.local_best_position = copy.deepcopy(self.position)
+        if score < self.local_best_score:
+            self.local_best_score = score
+            self.local_best_position = copy.deepcopy(self.position)
 
+    def record_score(self, current_iteration, score):
+        """
+        Records the score for the current position. Sets local_best_score if it's better than the previous best.
+        """
+        # record the score in the database (creating it if this is the first score)
+        new_db = not os.path.exists(self.tmp_db_path_name)
+        with sqlite3.connect(self.tmp_db_path_name, timeout=60) as score_db:
+            if new_db:
+                score_db.execute("PRAGMA journal_mode=TRUNCATE")
+                create_table_str = """create table {} 
+                                      ({}, {}, {} PRIMARY KEY ON CONFLICT REPLACE, {}, {})"""
+                create_table_str = create_table_str.format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME,
+                                                           PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME,
+                                                           VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME)
+                score_db.execute(create_table_str)
+
+            insert_command = "insert or replace into {} ({}, {}, {}, {}, {}) values (?, ?, ?, ?, ?)".\
+                format(RESULTS_TABLE_NAME, ITERATION_COLUMN_NAME, PARTICLE_COLUMN_NAME, POSITION_COLUMN_NAME,
+                       VELOCITY_COLUMN_NAME, SCORE_COLUMN_NAME)
+            score_db.execute(insert_command, (current_iteration, self.name, pickle_position_velocity(self.position),
+                                              pickle_position_velocity(self.velocity), score))
+
+        self.set_score(score)
+
+        if not os.path.exists(self.results_db_path_name) or \
+                not os.path.samefile(self.tmp_db_path_name, self.results_db_path_name):
             # make a copy in the results directory
             shutil.copy(self.tmp_db_path_name, self.results_db_path_name)
 
-        return self.local_best_score, copy.deepcopy(self.position), copy.deepcopy(self.velocity)
-
-    def get_ackley_score(self):
+    def score_current_position(self, current_iteration):
         """
-        Scores the current position using the Ackley function
-        :return: Score of position values X and Y in the Ackley function.
+        Works out the error score for the current position. Sets local_best_score if it's better than the previous best.
         """
-        x = self.position["X"]
-        y = self.position["Y"]
-        score = -20 * math.exp(-.2 * math.sqrt(.5 * (x ** 2 + y ** 2))) \
-                - math.exp(.5 * (math.cos(2 * math.pi * x) + math.cos(2 * math.pi * y))) + math.e + 20
-        return score
+        score_particle_positions([self], [current_iteration])
+        return self.local_best_score, copy.deepcopy(self.position), copy.deepcopy(self.velocity)
 
     def __str__(self):
         return "best={}, {}".format(self.local_best_score, self.local_best_position)
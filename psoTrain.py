@@ -1,20 +1,45 @@
 from datetime import datetime
 import copy
 import sys
-import sqlite3
 import argparse
 import os
 import time
-import shutil
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 
 import dask
 from distributed import LocalCluster
-from distributed import Client, as_completed
+from distributed import Client, Event, Queue, wait, TimeoutError
+
+from psoParticle import Particle, unpickle_position_velocity, score_particle_positions, read_batch_scores
+from Objectives import OBJECTIVES, is_cheap_objective, objective_model_runs, load_targets
+from Convergence import StoppingCriteria
+from Resources import worker_resources, check_worker_memory, evaluations_on_disk
+from Experiment import Experiment
+from Logger import Logger
+from config import REPLICATIONS, NUM_PARTICLES, ITERATIONS, OBJECTIVE, CHEAP_BATCH_SIZE, STOP_REPORT_PATH, \
+    MODELS_PER_WORKER, WARMUP_STEPS, RESUME_READ_THREADS, RECORD_RAW_ROWS, OUTPUT_DIR, TOPOLOGY_PATH, \
+    CALIBRATION_STEPS, CALIBRATION_RUNS_PER_CPU, MEMORY_TARGET, MEMORY_SPILL, MEMORY_PAUSE, MEMORY_TERMINATE, \
+    STALL_EVALUATIONS, MIN_SWARM_DIAMETER, MAX_HOURS, MAX_MODEL_RUNS, MERGE_QUEUE_NAME, STOP_EVENT_NAME, \
+    MODEL_MEMORY_GB, CALIBRATION_REPEATS, TOPOLOGY_MARGIN, TARGET_OUTPUTS
+
+
+def next_particles(particles_running, particle_epochs_completed, iterations, count):
+    """
+    Chooses the particles to run next: those not currently running with the fewest epochs done (and not finished).
 
-from psoParticle import Particle, unpickle_position_velocity, score_particle_position
-from config import REPLICATIONS, NUM_PARTICLES, ITERATIONS, \
-    ITERATION_COLUMN_NAME, SCORE_COLUMN_NAME, POSITION_COLUMN_NAME, VELOCITY_COLUMN_NAME, RESULTS_TABLE_NAME
-from HelpFunctions import error_print
+    :param particles_running: True for each particle that is currently running
+    :param particle_epochs_completed: Number of epochs completed by each particle
+    :param iterations: Number of epochs each particle has to complete
+    :param count: Maximum number of particles to return
+    :return: List of particle numbers, fewest epochs first
+    """
+    idle = [(epochs_done, pos) for pos, (is_running, epochs_done) in enumerate(zip(particles_running,
+                                                                                  particle_epochs_completed))
+            if not is_running and epochs_done < iterations]
+    idle.sort()
+    return [pos for _, pos in idle[:count]]
 
 
 class Train:
@@ -22,15 +47,23 @@ class Train:
     Runs a particle swarm optimisation algorithm
     """
 
-    def __init__(self, dask_client, num_workers):
+    def __init__(self, dask_client, num_workers, objective=OBJECTIVE, batch_size=CHEAP_BATCH_SIZE,
+                 stopping_criteria=None, objective_options=None, scratch_gb=None):
         self.dask_client = dask_client
         self.num_workers = num_workers
         self.replications = REPLICATIONS
 
+        # cheap objectives are scored many particles to a task, expensive ones a particle per task
+        self.objective = objective
+        self.batch_size = batch_size if is_cheap_objective(objective) else 1
+        # extra keyword arguments for the objective, e.g. {"models_per_worker": 8}
+        self.objective_options = objective_options if objective_options is not None else {}
+
         # get a dict of parameter ranges: {par_name: (min, max), ...}
         self.parameter_ranges = {"X": range(-100, 100), "Y": range(-200, 200, 2)}
 
-        self.particles = [Particle(i, self.parameter_ranges) for i in range(NUM_PARTICLES)]
+        scratch_path = Particle.scratch_dir()
+        self.particles = [Particle(i, self.parameter_ranges, objective, scratch_path) for i in range(NUM_PARTICLES)]
         self.particle_epochs_completed = [0] * len(self.particles)
         self.particles_running = [False] * len(self.particles)
 
@@ -40,97 +73,193 @@ class Train:
 
         self.iterations = ITERATIONS
 
-        # check how many iterations of each particle have been done
-        for particle_num, particle in enumerate(self.particles):
-            if os.path.exists(particle.results_db_path_name):
-                do_copy = True
-                # assume db file exists (initialised by Particle)
-                with sqlite3.connect(particle.results_db_path_name) as particle_score_db:
-                    particle_score_db.execute("PRAGMA journal_mode=TRUNCATE")
-                    query = "select {}, {}, {}, {} from {}".format(ITERATION_COLUMN_NAME, SCORE_COLUMN_NAME,
-                                                                   POSITION_COLUMN_NAME, VELOCITY_COLUMN_NAME,
-                                                                   RESULTS_TABLE_NAME)
-                    try:
-                        for row in particle_score_db.execute(query):
-                            particle.update_score_position_velocity(row[1], row[2], row[3], pickled=True)
-                            self.particle_epochs_completed[particle_num] = \
-                                max(row[0], self.particle_epochs_completed[particle_num])
-                            self.update_global(row[1], unpickle_position_velocity(row[2]))
-                    except sqlite3.OperationalError as e:
-                        # table doesn't exist so we don't need to do anything
-                        error_print("--\nTrain init, particle {}\n{}\n--".format(particle_num, e))
-                        do_copy = False
-                if do_copy:
-                    # make a copy in the tmp directory
-                    shutil.copy(particle.tmp_db_path_name, particle.results_db_path_name)
+        # early stopping (convergence and budgets)
+        self.stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteria()
+        self.stop_reason = None
+        self.outstanding_futures = set()
+        # set when training stops early, so the experiments still running stop and clean up
+        self.stop_event = Event(STOP_EVENT_NAME, client=dask_client)
+
+        # raw row merges the experiments started, which have to finish before training does
+        self.merge_queue = Queue(MERGE_QUEUE_NAME, client=dask_client)
+        self.merge_futures = set()
+
+        # number of evaluations whose model DBs fit on the scratch disk at once (None for no limit). The DBs stay
+        # there until their raw rows are merged, so this counts the evaluations running and merging.
+        self.max_evaluations_on_disk = None
+        if self.objective_options.get("record_rows", RECORD_RAW_ROWS):
+            self.max_evaluations_on_disk = evaluations_on_disk(self.objective_options.get("scratch_path", scratch_path),
+                                                               objective_model_runs(objective), scratch_gb)
+
+        # check how many iterations of each particle have been done (cheap objectives record all the particles in
+        # one DB, otherwise read the particle score DBs in parallel)
+        with ThreadPoolExecutor(max_workers=RESUME_READ_THREADS) as executor:
+            if is_cheap_objective(objective):
+                particles_rows = read_batch_scores(len(self.particles))
+            else:
+                particles_rows = executor.map(Particle.read_scores, self.particles)
+            for particle_num, (particle, rows) in enumerate(zip(self.particles, particles_rows)):
+                for row in rows or []:
+                    particle.update_score_position_velocity(row[1], row[2], row[3], pickled=True)
+                    self.particle_epochs_completed[particle_num] = \
+                        max(row[0], self.particle_epochs_completed[particle_num])
+                    self.update_global(row[1], unpickle_position_velocity(row[2]))
 
     def update_global(self, score, position):
+        """
+        Updates the global best if the score is better.
+        :return: True if the global best improved
+        """
         if score < self.global_best_score:
             self.global_best_position = position
             self.global_best_score = score
+            return True
+        return False
 
     def solve(self):
+        self.stopping_criteria.start()
+        self.stop_event.clear()
+
         # start off some particles
-        futures = []
-        for particle in self.particles:  # [:max(int((self.num_workers + 1) / self.replications), 1)]:
-            futures.append(self.create_parallel_particle_future(particle.name))
-            # time.sleep(60)
+        self.submit_particles(self.next_particles(self.dispatch_count(len(self.particles))))
+
+        while len(self.outstanding_futures) > 0 or len(self.merge_futures) > 0:
+            # wait no longer than the time budget allows, so it can't be overrun by a slow evaluation. Finished
+            # merges also wake this up, as they free scratch disk for more evaluations.
+            try:
+                done, _ = wait(list(self.outstanding_futures | self.merge_futures),
+                               timeout=self.stopping_criteria.remaining_seconds(), return_when="FIRST_COMPLETED")
+            except TimeoutError:
+                done = []
+
+            done = [future for future in done if future in self.outstanding_futures]
+            finished = 0
+            for future, results in zip(done, self.dask_client.gather(done)):
+                self.outstanding_futures.discard(future)
+                for particle_num, score, position, velocity, model_runs in results:
+                    self.particles[particle_num].update_score_position_velocity(score, position, velocity)
+
+                    # particle not running anymore
+                    self.particles_running[particle_num] = False
+                    # update the epoch
+                    self.particle_epochs_completed[particle_num] += 1
+                    # see if there's a new best score
+                    improved = self.update_global(score, position)
+                    self.stopping_criteria.add_evaluation(improved, model_runs)
+                    finished += 1
+            self.collect_merges()
+
+            if min(self.particle_epochs_completed) >= self.iterations:
+                # finished normally, whatever the criteria would say about the last evaluations
+                break
+
+            self.stop_reason = self.stopping_criteria.stop_reason([particle.position for particle in self.particles])
+            if self.stop_reason is not None:
+                break
+
+            # find the next particles (min epochs done and not currently running)
+            next_particles = self.next_particles(self.dispatch_count(finished))
+            for particle_num in next_particles:
+                particle = self.particles[particle_num]
+
+                # update for the next run
+                particle.update_velocity(self.global_best_position)
+                particle.update_position()
+
+            # score the particle positions
+            self.submit_particles(next_particles)
+
+        if self.stop_reason is not None:
+            # converged or out of budget - stop the rest, and wait for their experiments to remove their model DBs
+            # (or queue their merges, if they had already finished)
+            self.stop_event.set()
+            wait(list(self.outstanding_futures))
+            self.outstanding_futures.clear()
+            for particle_num in range(len(self.particles)):
+                self.particles_running[particle_num] = False
+        else:
+            self.stop_reason = "all particles completed {} iterations".format(self.iterations)
 
-        completed = as_completed(futures, with_results=True)
+        # the experiment DBs aren't all written until the raw row merges finish
+        self.collect_merges()
+        wait(list(self.merge_futures))
+        self.collect_merges()
 
-        for batch in completed.batches():
-            for future, (particle_num, score, position, velocity) in batch:
-                self.particles[particle_num].update_score_position_velocity(score, position, velocity)
+        self.save_stop_report()
 
-                # particle not running anymore
-                self.particles_running[particle_num] = False
-                # update the epoch
-                self.particle_epochs_completed[particle_num] += 1
-                # see if there's a new best score
-                self.update_global(score, position)
-
-                # print("-- tassie devil\n{}\n{}\n{}\n".format([particle.name for particle in self.particles],
-                #                                              self.particle_epochs_completed,
-                #                                              self.particles_running))
-
-                # find the next particle (min epochs done and not currently running)
-                min_epochs = sys.maxsize
-                next_particle_pos = -1
-                for pos, (is_running, epochs_done) in enumerate(zip(self.particles_running,
-                                                                    self.particle_epochs_completed)):
-                    if not is_running and epochs_done < min_epochs:
-                        min_epochs = epochs_done
-                        next_particle_pos = pos
-                # print("min: {}".format(min_epochs))
-
-                if min_epochs < self.iterations:
-                    # not done yet - find the min particle
-                    particle = self.particles[next_particle_pos]
-
-                    # print("index={}, particle_num={}".format(particle_num, particle.name))
-
-                    # update for the next run
-                    particle.update_velocity(self.global_best_position)
-                    particle.update_position()
-
-                    # score the particle position
-                    completed.add(self.create_parallel_particle_future(particle_num))
         # do something with the results now
-        print("=========== Done ({}) ===============".format(self.iterations))
+        print("=========== Done ({}): {} ===============".format(self.iterations, self.stop_reason))
         print(self)
 
-    def create_parallel_particle_future(self, particle_num):
-        self.particles_running[particle_num] = True
-        print("creating future for {}\n{}\n{}\n{}\n".format(particle_num,
-                                                            [particle.name for particle in self.particles],
-                                                            self.particle_epochs_completed,
-                                                            self.particles_running))
-
-        particle_epoch = self.particle_epochs_completed[particle_num]
-        # print("iteration {}: particle {} (score={})".format(particle_epoch, particle_num,
-        #                                                     self.particles[particle_num].local_best_score))
-
-        future = self.dask_client.submit(score_particle_position, self.particles[particle_num], particle_epoch)
+    def save_stop_report(self):
+        """
+        Records why training stopped, alongside the particle score DBs (which already hold each particle's state).
+        """
+        with open(STOP_REPORT_PATH, "w") as report_file:
+            report_file.write("stopped: {}\n".format(self.stop_reason))
+            report_file.write("model runs: {}\n".format(self.stopping_criteria.model_runs))
+            report_file.write("epochs completed: {}\n".format(self.particle_epochs_completed))
+            report_file.write(str(self))
+
+    def collect_merges(self):
+        """
+        Takes the futures of the raw row merges started by the experiments off the merge queue, and lets go of the
+        ones that have finished.
+
+        :raises Exception: The error of a merge that failed (the experiment's raw rows weren't saved)
+        """
+        if self.merge_queue.qsize() > 0:
+            self.merge_futures.update(self.merge_queue.get(batch=True))
+
+        done = [future for future in self.merge_futures if future.done()]
+        # gathering raises the error of any merge that failed, rather than dropping it
+        self.dask_client.gather(done)
+        self.merge_futures.difference_update(done)
+
+    def dispatch_count(self, finished):
+        """
+        Number of particles to start now.
+
+        :param finished: Number of particle evaluations that just finished
+        :return: finished, or however many more evaluations fit on the scratch disk if that's limited
+        """
+        if self.max_evaluations_on_disk is None:
+            return finished
+        return max(self.max_evaluations_on_disk - len(self.outstanding_futures) - len(self.merge_futures), 0)
+
+    def next_particles(self, count):
+        """
+        Finds the particles to run next: those not currently running with the fewest epochs done.
+
+        :param count: Maximum number of particles to return
+        :return: List of particle numbers, fewest epochs first
+        """
+        return next_particles(self.particles_running, self.particle_epochs_completed, self.iterations, count)
+
+    def submit_particles(self, particle_nums):
+        """
+        Submits tasks scoring the particles, batch_size particles to a task.
+        """
+        for batch_start in range(0, len(particle_nums), self.batch_size):
+            self.create_parallel_particle_future(particle_nums[batch_start:batch_start + self.batch_size])
+
+    def create_parallel_particle_future(self, particle_nums):
+        """
+        Submits a single task that scores a batch of particles.
+
+        :param particle_nums: List of particle numbers to score in the task
+        :return: Future of the list of particle results
+        """
+        for particle_num in particle_nums:
+            self.particles_running[particle_num] = True
+        particles = [self.particles[particle_num] for particle_num in particle_nums]
+        particle_epochs = [self.particle_epochs_completed[particle_num] for particle_num in particle_nums]
+        print("creating future for {} (epochs {})".format(particle_nums, particle_epochs))
+
+        # not pure: scoring records to the score DBs, and hashing every particle to name the task is slow
+        future = self.dask_client.submit(score_particle_positions, particles, particle_epochs,
+                                         self.objective_options, pure=False)
+        self.outstanding_futures.add(future)
 
         return future
 
@@ -143,38 +272,217 @@ class Train:
         return train_string
 
 
-def setup_dask_client(num_cpus, arg_memory):
-    # make the memory cutoffs more forgiving --- NOT WORKING
-    with dask.config.set({"distributed.worker.memory.pause": False,
-                          "distributed.worker.memory.spill": False,
-                          "distributed.worker.memory.target": False,
-                          "distributed.worker.memory.terminate": .999}):
+def setup_dask_client(num_cpus, arg_memory, threads_per_worker=1,
+                      memory_fractions=(MEMORY_TARGET, MEMORY_SPILL, MEMORY_PAUSE, MEMORY_TERMINATE),
+                      model_memory_gb=MODEL_MEMORY_GB):
+    """
+    Starts a local cluster. Each worker declares its share of the memory (plus merge slots) as resources, so tasks
+    that declare their needs are only packed onto a worker while they fit.
+
+    :param num_cpus: Total number of cores (threads) to use
+    :param arg_memory: Total memory to split between the workers in GB
+    :param threads_per_worker: Number of threads in each worker process
+    :param memory_fractions: Worker memory (target, spill, pause, terminate) fractions. False disables one.
+    :param model_memory_gb: Memory each model run needs in GB, checked against the memory per worker (None for
+                            workloads that don't run models)
+    """
+    # set the memory cutoffs for the whole process (not just while the cluster starts) so the nannies and
+    # workers all see them
+    memory_target, memory_spill, memory_pause, memory_terminate = memory_fractions
+    dask.config.set({"distributed.worker.memory.target": memory_target,
+                     "distributed.worker.memory.spill": memory_spill,
+                     "distributed.worker.memory.pause": memory_pause,
+                     "distributed.worker.memory.terminate": memory_terminate})
 
-        total_memory = arg_memory * 10 ** 9
-        # work out resources for the local cluster
-        mem_limit = round(total_memory / num_cpus)
+    num_workers = max(num_cpus // threads_per_worker, 1)
 
-        cluster = LocalCluster(n_workers=num_cpus, threads_per_worker=1, memory_limit=mem_limit)
-        # print([worker.mempry for worker in cluster.workers])
+    # work out resources for the local cluster
+    mem_limit = round(arg_memory * 10 ** 9 / num_workers)
+    if model_memory_gb is not None:
+        check_worker_memory(mem_limit / 10 ** 9, model_memory_gb)
+    resources = worker_resources(mem_limit / 10 ** 9)
 
-        dask_client = Client(cluster, timeout=600)
+    cluster = LocalCluster(n_workers=num_workers, threads_per_worker=threads_per_worker, memory_limit=mem_limit,
+                           resources=resources)
+
+    dask_client = Client(cluster, timeout=600)
+    print("workers: {} x {} threads, resources {}, memory fractions {}".format(num_workers, threads_per_worker,
+                                                                               resources, memory_fractions))
 
     return dask_client, cluster
 
 
+def calibrate_topology(num_cpus, arg_memory, threads_per_worker, scratch_path, memory_fractions, models_per_worker,
+                       model_memory_gb=MODEL_MEMORY_GB, repeats=CALIBRATION_REPEATS):
+    """
+    Measures model throughput on a cluster with the given topology by running a few short models (logging to
+    their databases) and merging the databases, as an experiment does. The measurement is repeated on the same
+    cluster, as a single one is too short to tell topologies apart from noise.
+
+    :param repeats: Number of times to measure the throughput
+    :return: Median model runs per second
+    """
+    dask_client, cluster = setup_dask_client(num_cpus, arg_memory, threads_per_worker, memory_fractions,
+                                             model_memory_gb)
+    experiment_name = "calibrate_t{}".format(threads_per_worker)
+    num_runs = num_cpus * CALIBRATION_RUNS_PER_CPU
+    run_specs = [(experiment_name, "s_0", run_id, num_runs, CALIBRATION_STEPS, scratch_path)
+                 for run_id in range(num_runs)]
+
+    throughputs = []
+    for _ in range(repeats):
+        start = time.time()
+        model_runs = Experiment.run_model_specs(dask_client, run_specs, models_per_worker, model_memory_gb)
+        loggers_info = [logger_info[:2] for _, logger_info in model_runs]
+        out_db_filepath = Logger.gather_databases(experiment_name, loggers_info)
+        throughputs.append(num_runs / (time.time() - start))
+        os.remove(out_db_filepath)
+
+    dask_client.close()
+    cluster.close()
+
+    throughput = statistics.median(throughputs)
+    print("calibration: {} threads per worker, scratch {}: {} runs/s (of {})".format(
+        threads_per_worker, scratch_path, round(throughput, 3), [round(t, 3) for t in throughputs]))
+    return throughput
+
+
+def tune_topology(num_cpus, arg_memory, workload_name, scratch_locations,
+                  memory_fractions=(MEMORY_TARGET, MEMORY_SPILL, MEMORY_PAUSE, MEMORY_TERMINATE),
+                  models_per_worker=MODELS_PER_WORKER, model_memory_gb=MODEL_MEMORY_GB, default_threads_per_worker=1):
+    """
+    Picks the cluster topology (threads per worker, and so the memory per worker, and scratch location) with the
+    best model throughput. A topology other than the default (default_threads_per_worker and the first scratch
+    location) is only chosen if it beats the default by TOPOLOGY_MARGIN. Settings are saved for each workload, so
+    later runs of the same workload reuse them instead of calibrating again. The kind of scratch location is saved
+    rather than its path, as the path (e.g. $SLURM_TMPDIR) changes from job to job.
+
+    :param num_cpus: Total number of cores (threads) to use
+    :param arg_memory: Total memory to split between the workers in GB
+    :param workload_name: Name identifying the workload the settings are for
+    :param scratch_locations: Candidate locations for model databases for this job: {kind: path}, default first
+    :param default_threads_per_worker: Threads per worker of the default topology
+    :return: Dictionary of the chosen settings:
+             {"threads_per_worker": ..., "scratch": kind, "scratch_path": ..., "throughput": ...}
+    """
+    workload_key = "{}-c_{}-m_{}-mpw_{}-mm_{}".format(workload_name, num_cpus, arg_memory, models_per_worker,
+                                                      model_memory_gb)
+
+    saved_topologies = {}
+    if os.path.exists(TOPOLOGY_PATH):
+        with open(TOPOLOGY_PATH) as topology_file:
+            saved_topologies = json.load(topology_file)
+    saved = saved_topologies.get(workload_key)
+    if saved is not None and saved.get("scratch") in scratch_locations:
+        print("reusing topology for {}: {}".format(workload_key, saved))
+        return dict(saved, scratch_path=scratch_locations[saved["scratch"]])
+
+    # candidate topologies, default first; scratch locations with the same path in this job are only measured once
+    default_scratch = next(iter(scratch_locations))
+    candidates = [(default_threads_per_worker, default_scratch)]
+    threads_per_worker = 1
+    while threads_per_worker <= num_cpus:
+        if num_cpus % threads_per_worker == 0:
+            scratch_paths = set()
+            for scratch, scratch_path in scratch_locations.items():
+                if scratch_path not in scratch_paths and (threads_per_worker, scratch) not in candidates:
+                    candidates.append((threads_per_worker, scratch))
+                scratch_paths.add(scratch_path)
+        threads_per_worker *= 2
+
+    default = None
+    best = None
+    for threads_per_worker, scratch in candidates:
+        throughput = calibrate_topology(num_cpus, arg_memory, threads_per_worker, scratch_locations[scratch],
+                                        memory_fractions, models_per_worker, model_memory_gb)
+        topology = {"threads_per_worker": threads_per_worker, "scratch": scratch, "throughput": throughput}
+        if default is None:
+            default = topology
+        elif best is None or throughput > best["throughput"]:
+            best = topology
+
+    # differences smaller than the margin are likely noise, so they don't move away from the default
+    if best is None or best["throughput"] < default["throughput"] * (1 + TOPOLOGY_MARGIN):
+        best = default
+
+    saved_topologies[workload_key] = best
+    with open(TOPOLOGY_PATH, "w") as topology_file:
+        json.dump(saved_topologies, topology_file, indent=2)
+
+    print("chose topology for {}: {}".format(workload_key, best))
+    return dict(best, scratch_path=scratch_locations[best["scratch"]])
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run a Training Experiment.')
     parser.add_argument('-c', '--cpus', type=int, default=2,
                         help='CPUs to use (default: 2)')
     parser.add_argument('-m', '--memory', type=int, default=10,
                         help='Total memory available to the experiment in GB (default is 10)')
+    parser.add_argument('-t', '--threads-per-worker', type=int, default=1,
+                        help='Threads in each worker process (default: 1)')
+    parser.add_argument('--model-memory-gb', type=float, default=MODEL_MEMORY_GB,
+                        help='Memory each model run needs in GB (default: {})'.format(MODEL_MEMORY_GB))
+    parser.add_argument('--scratch-gb', type=float, default=None,
+                        help='Scratch disk available for model databases in GB (default is the free space)')
+    parser.add_argument('--memory-fractions', type=float, nargs=4,
+                        default=[MEMORY_TARGET, MEMORY_SPILL, MEMORY_PAUSE, MEMORY_TERMINATE],
+                        metavar=('TARGET', 'SPILL', 'PAUSE', 'TERMINATE'),
+                        help='Worker memory management thresholds as fractions of worker memory '
+                             '(default: {} {} {} {})'.format(MEMORY_TARGET, MEMORY_SPILL, MEMORY_PAUSE,
+                                                             MEMORY_TERMINATE))
+    parser.add_argument('-o', '--objective', choices=sorted(OBJECTIVES), default=OBJECTIVE,
+                        help='Objective used to score particle positions (default: {})'.format(OBJECTIVE))
+    parser.add_argument('--targets',
+                        help='JSON file of the target output means experiments are scored against: '
+                             '{info_type: target} (default: the test model\'s expected means)')
+    parser.add_argument('-b', '--batch-size', type=int, default=CHEAP_BATCH_SIZE,
+                        help='Particles scored per task for cheap objectives (default: {})'.format(CHEAP_BATCH_SIZE))
+    parser.add_argument('-a', '--auto-tune', action='store_true',
+                        help='Calibrate (or reuse saved) threads per worker and scratch location')
+    parser.add_argument('--models-per-worker', type=int, default=MODELS_PER_WORKER,
+                        help='Models co-scheduled on an event loop in each task. Each worker runs as many tasks '
+                             'at once as its threads and memory allow (default: {})'.format(MODELS_PER_WORKER))
+    parser.add_argument('-w', '--warmup-steps', type=int, default=WARMUP_STEPS,
+                        help='Warm-up steps shared by all replications of a scenario, run once and forked from a '
+                             'snapshot (default: {})'.format(WARMUP_STEPS))
+    parser.add_argument('--no-raw-rows', dest='record_rows', action='store_false', default=RECORD_RAW_ROWS,
+                        help='Only keep summary statistics of the model outputs, without writing the raw rows')
+    parser.add_argument('--stall', type=int, default=STALL_EVALUATIONS,
+                        help='Stop after this many evaluations without a global best improvement')
+    parser.add_argument('--min-diameter', type=float, default=MIN_SWARM_DIAMETER,
+                        help='Stop when the swarm diameter falls below this')
+    parser.add_argument('--max-hours', type=float, default=MAX_HOURS,
+                        help='Stop after this many hours of wall-clock time')
+    parser.add_argument('--max-model-runs', type=int, default=MAX_MODEL_RUNS,
+                        help='Stop after this many model runs')
 
     args = parser.parse_args()
     # print(args)
 
-    client, cluster = setup_dask_client(args.cpus, args.memory)
-
-    t = Train(client, args.cpus)
+    targets = TARGET_OUTPUTS if args.targets is None else load_targets(args.targets)
+
+    threads_per_worker = args.threads_per_worker
+    scratch_path = Particle.scratch_dir()
+    if args.auto_tune:
+        topology = tune_topology(args.cpus, args.memory, args.objective,
+                                 {"tmpdir": scratch_path, "output": OUTPUT_DIR}, args.memory_fractions,
+                                 args.models_per_worker, args.model_memory_gb, threads_per_worker)
+        threads_per_worker = topology["threads_per_worker"]
+        scratch_path = topology["scratch_path"]
+
+    client, cluster = setup_dask_client(args.cpus, args.memory, threads_per_worker, args.memory_fractions,
+                                        args.model_memory_gb if objective_model_runs(args.objective) > 0 else None)
+
+    stopping = StoppingCriteria(args.stall, args.min_diameter,
+                                None if args.max_hours is None else args.max_hours * 60 * 60,
+                                args.max_model_runs)
+
+    t = Train(client, args.cpus, args.objective, args.batch_size, stopping,
+              {"models_per_worker": args.models_per_worker, "scratch_path": scratch_path,
+               "warmup_steps": args.warmup_steps, "record_rows": args.record_rows,
+               "model_memory_gb": args.model_memory_gb,
+               "targets": targets}, args.scratch_gb)
     t.solve()
 
     print("finished solving. closing client")